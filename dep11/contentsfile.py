@@ -17,6 +17,7 @@
 
 import os
 import gzip
+import lmdb
 import logging as log
 
 from .package import read_packages_dict_from_file
@@ -24,6 +25,14 @@ from .package import read_packages_dict_from_file
 
 __all__ = list()
 
+# the parts of the Contents files the generator is interested in,
+# we do not index anything else
+INDEXED_PATH_PREFIXES = ('usr/share/icons/',
+                         'usr/share/pixmaps/',
+                         'usr/share/applications/',
+                         'usr/share/metainfo/',
+                         'usr/share/appdata/')
+
 def _decode_contents_line(line):
     try:
         return str(line, 'utf-8')
@@ -42,7 +51,7 @@ def _file_pkg_from_contents_line(raw_line):
     return path, pkgname
 
 
-def parse_contents_file(mirror_dir, suite_name, component, arch_name):
+def get_contents_fname(mirror_dir, suite_name, component, arch_name):
     contents_basename = "Contents-%s.gz" % (arch_name)
     contents_fname = os.path.join(mirror_dir, "dists", suite_name, component, contents_basename)
 
@@ -52,12 +61,25 @@ def parse_contents_file(mirror_dir, suite_name, component, arch_name):
         path = os.path.join(mirror_dir, "dists", suite_name, contents_basename)
         if os.path.isfile(path):
             contents_fname = path
+    return contents_fname
+
 
+def _get_packages_dict(mirror_dir, suite_name, component, arch_name, package_index=None):
     # we want information about the whole package, not only the package-name
+    if package_index:
+        packages = package_index.get_packages(mirror_dir, suite_name, component, arch_name)
+    else:
+        packages = read_packages_dict_from_file(mirror_dir, suite_name, component, arch_name)
     packages_dict = dict()
-    for name, pkg in read_packages_dict_from_file(mirror_dir, suite_name, component, arch_name).items():
+    for name, pkg in packages.items():
         pkg.filename = os.path.join(mirror_dir, pkg.filename)
         packages_dict[name] = pkg
+    return packages_dict
+
+
+def parse_contents_file(mirror_dir, suite_name, component, arch_name):
+    contents_fname = get_contents_fname(mirror_dir, suite_name, component, arch_name)
+    packages_dict = _get_packages_dict(mirror_dir, suite_name, component, arch_name)
 
     # load and preprocess the large Contents file.
     with gzip.open(contents_fname, 'r') as f:
@@ -71,3 +93,192 @@ def parse_contents_file(mirror_dir, suite_name, component, arch_name):
 
 
 __all__.append('parse_contents_file')
+
+
+class ContentsIndex:
+    """
+    A persistent, LMDB based index of the Contents-<arch>.gz files of an archive.
+
+    Only the parts of the Contents data which are interesting for the generator are indexed.
+    The index is keyed by suite/component/arch and is only rebuilt if the modification time
+    or size of the Contents file it was built from changes, so the large Contents files only
+    need to be parsed once and the data can be shared by everything that needs it.
+    """
+
+    def __init__(self, package_index=None):
+        self._package_index = package_index
+        self._filesdb = None
+        self._sourcesdb = None
+        self._dbenv = None
+        self._opened = False
+
+        # LMDB needs to know about the maximum size it can use, use the same value as the
+        # data cache here.
+        self._map_size = pow(1024, 4)
+
+        # amount of Contents entries we write to the database per transaction
+        self._write_chunk_size = 100000
+
+        # bumped whenever the layout of the index changes, so old indexes get rebuilt
+        self._format_version = 2
+
+
+    def open(self, index_dir):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self._dbenv = lmdb.open(index_dir, max_dbs=2, map_size=self._map_size, metasync=False)
+
+        self._filesdb = self._dbenv.open_db(b'files')
+        self._sourcesdb = self._dbenv.open_db(b'sources')
+
+        self._opened = True
+        return True
+
+
+    def close(self):
+        if not self._opened:
+            return
+        self._dbenv.close()
+
+        self._filesdb = None
+        self._sourcesdb = None
+        self._dbenv = None
+        self._opened = False
+
+
+    def _index_prefix(self, suite_name, component, arch_name):
+        return bytes("%s/%s/%s" % (suite_name, component, arch_name), 'utf-8')
+
+
+    def _source_stamp(self, contents_fname):
+        st = os.stat(contents_fname)
+        return bytes("%i %s %i %i" % (self._format_version, contents_fname, st.st_mtime_ns, st.st_size), 'utf-8')
+
+
+    def _drop_index(self, prefix):
+        with self._dbenv.begin(db=self._filesdb, write=True) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                while cursor.key().startswith(prefix):
+                    if not cursor.delete():
+                        break
+
+
+    def update(self, mirror_dir, suite_name, component, arch_name):
+        '''
+        Ensure the index for the given suite/component/arch is in sync
+        with the Contents file in the archive, and rebuild it if necessary.
+        '''
+
+        contents_fname = get_contents_fname(mirror_dir, suite_name, component, arch_name)
+        if not os.path.isfile(contents_fname):
+            log.warning("Contents file '%s' does not exist." % (contents_fname))
+            return False
+
+        source_key = self._index_prefix(suite_name, component, arch_name)
+        stamp = self._source_stamp(contents_fname)
+        with self._dbenv.begin(db=self._sourcesdb) as txn:
+            if txn.get(source_key) == stamp:
+                return True
+
+        log.info("Building Contents index for %s/%s/%s" % (suite_name, component, arch_name))
+        with self._dbenv.begin(db=self._sourcesdb, write=True) as txn:
+            txn.delete(source_key)
+            txn.delete(source_key + b'\0packages')
+
+        prefix = source_key + b'\0'
+        self._drop_index(prefix)
+
+        # write the index in chunks, so we never exceed the maximum size of a LMDB transaction
+        entries = list()
+        def write_entries():
+            with self._dbenv.begin(db=self._filesdb, write=True) as txn:
+                for fname, pkgname in entries:
+                    txn.put(prefix + bytes(fname, 'utf-8'), bytes(pkgname, 'utf-8'))
+            entries.clear()
+
+        # we also remember which packages are listed at all, so packages missing from the
+        # Contents data can be told apart from packages which don't have interesting files
+        pkgnames = set()
+        with gzip.open(contents_fname, 'r') as f:
+            for line in f:
+                line = _decode_contents_line(line)
+                parts = line.rsplit(None, 1)
+                if len(parts) == 2:
+                    pkgnames.update(p.split("/")[-1] for p in parts[1].split(","))
+                if not line.startswith(INDEXED_PATH_PREFIXES):
+                    continue
+                fname, pkgname = _file_pkg_from_contents_line(line)
+                if not fname:
+                    continue
+                entries.append((fname, pkgname))
+                if len(entries) >= self._write_chunk_size:
+                    write_entries()
+        write_entries()
+
+        # only mark the index as valid once it is complete
+        with self._dbenv.begin(db=self._sourcesdb, write=True) as txn:
+            txn.put(source_key + b'\0packages', bytes("\n".join(sorted(pkgnames)), 'utf-8'))
+            txn.put(source_key, stamp)
+        return True
+
+
+    def get_files(self, suite_name, component, arch_name, path_prefix=''):
+        '''
+        Yield (filename, package-name) tuples for all indexed files
+        starting with the given path prefix.
+        '''
+
+        prefix = self._index_prefix(suite_name, component, arch_name) + b'\0'
+        key_prefix = prefix + bytes(path_prefix, 'utf-8')
+        with self._dbenv.begin(db=self._filesdb) as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(key_prefix):
+                return
+            for key, value in cursor:
+                if not key.startswith(key_prefix):
+                    break
+                yield str(key[len(prefix):], 'utf-8'), str(value, 'utf-8')
+
+
+    def get_package_names(self, suite_name, component, arch_name):
+        '''
+        Return the set of names of all packages listed in the Contents data,
+        or None if the index doesn't have any data for the given suite/component/arch.
+        '''
+
+        source_key = self._index_prefix(suite_name, component, arch_name)
+        with self._dbenv.begin(db=self._sourcesdb) as txn:
+            if not txn.get(source_key):
+                return None
+            data = txn.get(source_key + b'\0packages')
+        if data is None:
+            return None
+        return set(str(data, 'utf-8').split("\n")) if data else set()
+
+
+    def get_package_files(self, mirror_dir, suite_name, component, arch_name, path_prefixes=('',)):
+        '''
+        Works like parse_contents_file(), but reads the data from the index.
+        Yields (filename, Package) tuples for all indexed files starting with one of the given path prefixes.
+        '''
+
+        if not self.update(mirror_dir, suite_name, component, arch_name):
+            return
+        packages_dict = _get_packages_dict(mirror_dir, suite_name, component, arch_name, self._package_index)
+
+        # don't visit any file twice, in case one prefix contains another one
+        prefixes = list()
+        for prefix in sorted(set(path_prefixes)):
+            if prefixes and prefix.startswith(prefixes[-1]):
+                continue
+            prefixes.append(prefix)
+
+        for prefix in prefixes:
+            for fname, pkgname in self.get_files(suite_name, component, arch_name, prefix):
+                pkg = packages_dict.get(pkgname)
+                if not pkg:
+                    continue
+                yield fname, pkg
+
+__all__.append('ContentsIndex')
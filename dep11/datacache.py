@@ -16,11 +16,15 @@
 # License along with this program.
 
 import os
-import glob
 import shutil
 import logging as log
 import lmdb
 from math import pow
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .mediastore import MediaStore, screenshot_key
+from .profiling import stage
 
 
 def tobytes(s):
@@ -36,11 +40,28 @@ class DataCache:
         self._hintsdb = None
         self._datadb = None
         self._statsdb = None
+        self._shotsdb = None
+        self._exportdb = None
+        self._gidrefsdb = None
+        self._orphansdb = None
+        self._mediadb = None
+        self._mediarefsdb = None
+        self._reportsdb = None
         self._dbenv = None
+        # bumped whenever the report data changes its layout
+        self._reports_format_version = 2
+        self._dbs = dict()
         self.cache_dir = None
         self._opened = False
 
         self.media_dir = media_dir
+        # content-addressed store for generated media, shared by all suites
+        self.media_store = None
+
+        # pending writes of the current batch, see begin_batch()
+        self._batch = None
+        self._batch_size = 0
+        self._batch_pkg_count = 0
 
         # set a huge map size to be futureproof.
         # This means we're cruel to non-64bit users, but this
@@ -49,21 +70,45 @@ class DataCache:
 
 
     def open(self, cachedir):
-        self._dbenv = lmdb.open(cachedir, max_dbs=4, map_size=self._map_size, metasync=False)
+        self._dbenv = lmdb.open(cachedir, max_dbs=11, map_size=self._map_size, metasync=False)
 
         self._pkgdb = self._dbenv.open_db(b'packages')
         self._hintsdb = self._dbenv.open_db(b'hints')
         self._datadb = self._dbenv.open_db(b'metadata')
         self._statsdb = self._dbenv.open_db(b'statistics')
+        self._shotsdb = self._dbenv.open_db(b'screenshots')
+        self._exportdb = self._dbenv.open_db(b'export')
+        self._gidrefsdb = self._dbenv.open_db(b'gidrefs')
+        self._orphansdb = self._dbenv.open_db(b'orphans')
+        self._mediadb = self._dbenv.open_db(b'media')
+        self._mediarefsdb = self._dbenv.open_db(b'mediarefs')
+        self._reportsdb = self._dbenv.open_db(b'reports')
+
+        self._dbs = {b'packages': self._pkgdb,
+                     b'hints': self._hintsdb,
+                     b'metadata': self._datadb,
+                     b'statistics': self._statsdb,
+                     b'screenshots': self._shotsdb,
+                     b'export': self._exportdb,
+                     b'gidrefs': self._gidrefsdb,
+                     b'orphans': self._orphansdb,
+                     b'media': self._mediadb,
+                     b'mediarefs': self._mediarefsdb,
+                     b'reports': self._reportsdb}
+
+        self.media_store = MediaStore(os.path.join(cachedir, "media-store"))
 
         self._opened = True
         self.cache_dir = cachedir
+
+        self._ensure_gid_refs()
         return True
 
 
     def close(self):
         if not self._opened:
             return
+        self.end_batch()
         self._dbenv.close()
 
         self._pkgdb = None
@@ -71,6 +116,14 @@ class DataCache:
         self._datadb = None
         self._dbenv = None
         self._statsdb = None
+        self._shotsdb = None
+        self._exportdb = None
+        self._gidrefsdb = None
+        self._orphansdb = None
+        self._mediadb = None
+        self._mediarefsdb = None
+        self._reportsdb = None
+        self._dbs = dict()
         self._opened = False
 
 
@@ -81,44 +134,226 @@ class DataCache:
         self.open(self.cache_dir)
 
 
+    def __getstate__(self):
+        # LMDB handles can not be shared with other processes, so we only send over
+        # the location of the cache. The receiving process needs to call reopen().
+        state = self.__dict__.copy()
+        for key in state.keys():
+            if key.endswith('db'):
+                state[key] = None
+        state['_dbenv'] = None
+        state['_dbs'] = dict()
+        state['_opened'] = False
+        state['_batch'] = None
+        return state
+
+
+    def begin_batch(self, batch_size=0):
+        '''
+        Collect all following writes to the cache in memory, instead of writing
+        each of them in its own transaction. Reads on this object take the pending data
+        into account, while cursor-based scans only see committed data.
+        If batch_size is not zero, the batch is committed automatically every time data
+        for that amount of packages has been added to it.
+        '''
+        if self._batch is not None:
+            self.commit_batch()
+        self._batch = dict()
+        self._batch_size = batch_size
+        self._batch_pkg_count = 0
+
+
+    def commit_batch(self):
+        '''
+        Write all pending data of the current batch to the database, in one transaction.
+        '''
+        if not self._batch:
+            self._batch_pkg_count = 0
+            return
+
+        with self._dbenv.begin(write=True) as txn:
+            for (db_name, key), value in self._batch.items():
+                if value is None:
+                    txn.delete(key, db=self._dbs[db_name])
+                else:
+                    txn.put(key, value, db=self._dbs[db_name])
+        self._batch.clear()
+        self._batch_pkg_count = 0
+
+
+    def end_batch(self):
+        '''
+        Commit the current batch and write data directly again.
+        '''
+        if self._batch is None:
+            return
+        self.commit_batch()
+        self._batch = None
+
+
+    def take_batch(self):
+        '''
+        End the current batch without committing it, and return its pending write operations.
+        The result can be sent to another process and be written there using apply_batch().
+        '''
+        if self._batch is None:
+            return list()
+        ops = list(self._batch.items())
+        self._batch = None
+        return ops
+
+
+    def apply_batch(self, ops):
+        '''
+        Apply the write operations of one package, as returned by take_batch().
+        '''
+        if self._batch is None:
+            with self._dbenv.begin(write=True) as txn:
+                for (db_name, key), value in ops:
+                    if value is None:
+                        txn.delete(key, db=self._dbs[db_name])
+                    else:
+                        txn.put(key, value, db=self._dbs[db_name])
+            return
+
+        for key, value in ops:
+            self._batch[key] = value
+        self._batch_package_added()
+
+
+    @contextmanager
+    def write_batch(self, batch_size=0):
+        '''
+        Context manager for a batch of writes, see begin_batch().
+        '''
+        self.begin_batch(batch_size)
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+
+    def _batch_package_added(self):
+        if self._batch is None:
+            return
+        self._batch_pkg_count += 1
+        if self._batch_size and self._batch_pkg_count >= self._batch_size:
+            self.commit_batch()
+
+
+    def _get(self, db_name, key):
+        if self._batch is not None and (db_name, key) in self._batch:
+            return self._batch[(db_name, key)]
+        with self._dbenv.begin(db=self._dbs[db_name]) as txn:
+            return txn.get(key)
+
+
+    def _put(self, db_name, key, value):
+        if self._batch is not None:
+            self._batch[(db_name, key)] = value
+            return
+        with self._dbenv.begin(db=self._dbs[db_name], write=True) as txn:
+            txn.put(key, value)
+
+
+    def _delete(self, db_name, key):
+        if self._batch is not None:
+            self._batch[(db_name, key)] = None
+            return
+        with self._dbenv.begin(db=self._dbs[db_name], write=True) as txn:
+            txn.delete(key)
+
+
     def metadata_exists(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as txn:
-            return txn.get(gid) != None
+        return self._get(b'metadata', gid) != None
 
 
     def get_metadata(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as dtxn:
-                d = dtxn.get(tobytes(gid))
-                if not d:
-                    return None
-                return str(d, 'utf-8')
+        d = self._get(b'metadata', gid)
+        if not d:
+            return None
+        return str(d, 'utf-8')
 
 
     def set_metadata(self, global_id, yaml_data):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb, write=True) as txn:
-            txn.put(gid, tobytes(yaml_data))
+        self._put(b'metadata', gid, tobytes(yaml_data))
+
+
+    def _gid_ref_key(self, gid, pkgid):
+        return tobytes(gid) + b'\0' + tobytes(pkgid)
+
+
+    def _ensure_gid_refs(self):
+        '''
+        Build the index of packages referencing a component global-id, if this
+        cache was created before we maintained it.
+        '''
+        with self._dbenv.begin(db=self._gidrefsdb) as txn:
+            if txn.get(b'\0') is not None:
+                return
+
+        log.info("Building component reference index")
+        with self._dbenv.begin(write=True) as txn:
+            cursor = txn.cursor(db=self._pkgdb)
+            for pkid, value in cursor:
+                if not value or value == b'ignore' or value == b'seen':
+                    continue
+                for gid in value.split(b'\n'):
+                    txn.put(self._gid_ref_key(gid, pkid), b'', db=self._gidrefsdb)
+
+            # components which already are orphaned should be removed on the next cleanup
+            cursor = txn.cursor(db=self._datadb)
+            for gid in cursor.iternext(values=False):
+                if not self._has_gid_refs(txn, gid):
+                    txn.put(gid, b'', db=self._orphansdb)
+
+            txn.put(b'\0', b'', db=self._gidrefsdb)
+
+
+    def _has_gid_refs(self, txn, gid):
+        prefix = tobytes(gid) + b'\0'
+        cursor = txn.cursor(db=self._gidrefsdb)
+        return cursor.set_range(prefix) and cursor.key().startswith(prefix)
+
+
+    def _set_gid_refs(self, pkgid, gids):
+        '''
+        Update the references of a package to component global-ids. Components which
+        lose a reference are remembered as possible orphans.
+        '''
+        old_gids = self.get_cpt_gids_for_pkg(pkgid) or list()
+        for gid in old_gids:
+            if gid in gids:
+                continue
+            self._delete(b'gidrefs', self._gid_ref_key(gid, pkgid))
+            self._put(b'orphans', tobytes(gid), b'')
+        for gid in gids:
+            if gid in old_gids:
+                continue
+            self._put(b'gidrefs', self._gid_ref_key(gid, pkgid), b'')
 
 
     def set_package_ignore(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-            txn.put(pkgid, b'ignore')
+        self._set_gid_refs(pkgid, list())
+        self._put(b'packages', pkgid, b'ignore')
+        self._drop_export_fragments(pkgid)
+        self._batch_package_added()
 
 
     def get_cpt_gids_for_pkg(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cs_str = txn.get(pkgid)
-            if not cs_str:
-                return None
-            cs_str = str(cs_str, 'utf-8')
-            if cs_str == 'ignore' or cs_str == 'seen':
-                return None
-            gids = cs_str.split("\n")
-            return gids
+        cs_str = self._get(b'packages', pkgid)
+        if not cs_str:
+            return None
+        cs_str = str(cs_str, 'utf-8')
+        if cs_str == 'ignore' or cs_str == 'seen':
+            return None
+        gids = cs_str.split("\n")
+        return gids
 
 
     def get_metadata_for_pkg(self, pkgid):
@@ -152,7 +387,8 @@ class DataCache:
                     gids.append(cpt.global_id)
                 else:
                     # get the metadata in YAML format
-                    md_yaml = cpt.to_yaml_doc()
+                    with stage('yaml-dump'):
+                        md_yaml = cpt.to_yaml_doc()
                     # we need to check for ignore reasons again, since generating
                     # the YAML doc may have raised more errors
                     if not cpt.has_ignore_reason():
@@ -164,28 +400,158 @@ class DataCache:
                 hints_str += hints_yml
 
         self.set_hints(pkgid, hints_str)
+        self._set_gid_refs(pkgid, gids)
         if gids:
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, bytes("\n".join(gids), 'utf-8'))
+            self._put(b'packages', pkgid, bytes("\n".join(gids), 'utf-8'))
         elif hints_str:
             # we need to set some value for this package, to show that we've seen it
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, b'seen')
+            self._put(b'packages', pkgid, b'seen')
+        self._drop_export_fragments(pkgid)
+        self._batch_package_added()
 
 
     def get_hints(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb) as txn:
-            hints = txn.get(pkgid)
-            if hints:
-                hints = str(hints, 'utf-8')
-            return hints
+        hints = self._get(b'hints', pkgid)
+        if hints:
+            hints = str(hints, 'utf-8')
+        return hints
 
 
     def set_hints(self, pkgid, hints_yml):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as txn:
-            txn.put(pkgid, tobytes(hints_yml))
+        self._put(b'hints', pkgid, tobytes(hints_yml))
+
+
+    def get_screenshot_info(self, url):
+        '''
+        Return the ETag and Last-Modified values of the last download of the given
+        screenshot URL, and the checksum of the data we stored in the media store.
+        '''
+        data = self._get(b'screenshots', tobytes(url))
+        if not data:
+            return None
+        etag, last_modified, checksum = str(data, 'utf-8').split('\n')
+        return {'etag': etag, 'last_modified': last_modified, 'checksum': checksum}
+
+
+    def set_screenshot_info(self, url, etag, last_modified, checksum):
+        data = "%s\n%s\n%s" % (etag if etag else "", last_modified if last_modified else "", checksum)
+        self._put(b'screenshots', tobytes(url), tobytes(data))
+
+
+    def _export_fragment_key(self, kind, pkgid):
+        return tobytes(kind) + b':' + tobytes(pkgid)
+
+
+    def get_export_fragment(self, kind, pkgid):
+        '''
+        Return the gzip-compressed data of the given kind ('data' or 'hints') we exported
+        for a package before, or None if we don't have any.
+        An empty fragment means that there was nothing to export for the package.
+        '''
+        return self._get(b'export', self._export_fragment_key(kind, pkgid))
+
+
+    def set_export_fragment(self, kind, pkgid, data):
+        self._put(b'export', self._export_fragment_key(kind, pkgid), data)
+        # the export writes fragments for many packages at once, so every fragment
+        # counts towards the size of the current batch
+        self._batch_package_added()
+
+
+    def _drop_export_fragments(self, pkgid):
+        for kind in ['data', 'hints']:
+            self._delete(b'export', self._export_fragment_key(kind, pkgid))
+
+
+    def get_icon_tar_member(self, global_id, size):
+        '''
+        Return the names of the icons of the given size a component has, and the
+        gzip-compressed tar data of these icons, or None if we don't know them yet.
+        '''
+        data = self._get(b'export', tobytes("icons:%s:%s" % (global_id, size)))
+        if data is None:
+            return None
+        names, member = data.split(b'\0', 1)
+        names = str(names, 'utf-8').split("\n") if names else list()
+        return names, member
+
+
+    def set_icon_tar_member(self, global_id, size, names, member):
+        data = tobytes("\n".join(names)) + b'\0' + member
+        self._put(b'export', tobytes("icons:%s:%s" % (global_id, size)), data)
+        # like export fragments, icon tarball members are written for many components at once
+        self._batch_package_added()
+
+
+    def _drop_icon_tar_members(self, txn, global_id):
+        prefix = b'icons:' + tobytes(global_id) + b':'
+        self._delete_prefix(txn, self._exportdb, prefix)
+
+
+    def get_report_fingerprints(self, section):
+        '''
+        Return a dict mapping the paths of the HTML pages of a report section
+        (e.g. "suite/component") to the fingerprints of the data they were rendered from.
+        '''
+        prefix = b'page:' + tobytes(section) + b'\0'
+        fingerprints = dict()
+        with self._dbenv.begin(db=self._reportsdb) as txn:
+            for key, value in self._iter_prefix(txn.cursor(), prefix):
+                fingerprints[str(key[len(prefix):], 'utf-8')] = str(value, 'utf-8')
+        return fingerprints
+
+
+    def set_report_fingerprints(self, section, fingerprints):
+        '''
+        Replace the page fingerprints of a report section.
+        '''
+        prefix = b'page:' + tobytes(section) + b'\0'
+        with self._dbenv.begin(db=self._reportsdb, write=True) as txn:
+            self._delete_prefix(txn, self._reportsdb, prefix)
+            for path, fingerprint in fingerprints.items():
+                txn.put(prefix + tobytes(path), tobytes(fingerprint))
+
+
+    def _report_fragment_key(self, kind, key):
+        return tobytes(kind) + b':' + tobytes(key)
+
+
+    def get_report_fragment(self, kind, key):
+        '''
+        Return a fragment of a report page we rendered before, or None.
+        Fragments of kind 'mdata' are keyed by the global-id of a component.
+        '''
+        return self._get(b'reports', self._report_fragment_key(kind, key))
+
+
+    def set_report_fragment(self, kind, key, data):
+        self._put(b'reports', self._report_fragment_key(kind, key), data)
+
+
+    def drop_report_fragments(self, kind):
+        '''
+        Remove all report fragments of the given kind.
+        '''
+        with self._dbenv.begin(db=self._reportsdb, write=True) as txn:
+            self._delete_prefix(txn, self._reportsdb, tobytes(kind) + b':')
+
+
+    def upgrade_reports(self):
+        '''
+        Drop report data older versions stored in a layout we don't use anymore.
+        This only does any work once, the format version is remembered in the database.
+        '''
+        version = bytes(str(self._reports_format_version), 'utf-8')
+        with self._dbenv.begin(db=self._reportsdb) as txn:
+            if txn.get(b'format-version') == version:
+                return
+
+        # drop the expanded hints of version 1
+        self.drop_report_fragments('hint')
+        with self._dbenv.begin(db=self._reportsdb, write=True) as txn:
+            txn.put(b'format-version', version)
 
 
     def _cleanup_empty_dirs(self, d):
@@ -194,29 +560,180 @@ class DataCache:
             parent = os.path.abspath(os.path.join(parent, os.pardir))
             if not os.path.isdir(parent):
                 return
-            if not os.listdir(parent):
-                os.rmdir(parent)
+            try:
+                if not os.listdir(parent):
+                    os.rmdir(parent)
+            except OSError:
+                # another deleter might be working on the same directory
+                return
+
+
+    def _media_ref_key(self, store_key, media_key):
+        return tobytes(store_key) + b'\0' + media_key
+
+
+    def add_media(self, global_id, component, kind, fname, store_key=None):
+        '''
+        Register a media file we created for a component in the media manifest.
+        The file needs to be located in the component's media directory.
+        If the file is a link to a file in the media store, store_key is its key there.
+        '''
+        if not os.path.isfile(fname):
+            return
+        gid = tobytes(global_id)
+        cpt_dir = os.path.join(self.media_dir, component, global_id)
+        key = gid + b'\0' + tobytes(os.path.relpath(fname, cpt_dir))
+
+        # keep track of which stored files are in use, so we know which ones we can prune
+        old_data = self._get(b'media', key)
+        old_store_key = str(old_data, 'utf-8').split('\n')[3] if old_data and old_data.count(b'\n') >= 3 else ''
+        if store_key is None:
+            store_key = old_store_key
+        elif store_key != old_store_key:
+            if old_store_key:
+                self._delete(b'mediarefs', self._media_ref_key(old_store_key, key))
+                self._put(b'mediarefs', b'\0' + tobytes(old_store_key), b'')
+            self._put(b'mediarefs', self._media_ref_key(store_key, key), b'')
+
+        data = "%s\n%s\n%i\n%s" % (component, kind, os.path.getsize(fname), store_key)
+        self._put(b'media', key, tobytes(data))
+        # the entry without a filename marks the media directory itself
+        self._put(b'media', gid + b'\0', tobytes(component))
+
+
+    def get_media(self, global_id):
+        '''
+        Yield (filename, archive component, kind, size) tuples for all media files
+        registered for the given component.
+        '''
+        prefix = tobytes(global_id) + b'\0'
+        with self._dbenv.begin(db=self._mediadb) as txn:
+            for key, data in self._iter_prefix(txn.cursor(), prefix):
+                if key == prefix:
+                    continue
+                component, kind, size = str(data, 'utf-8').split('\n')[:3]
+                yield str(key[len(prefix):], 'utf-8'), component, kind, int(size)
+
+
+    def _ensure_media_manifest(self):
+        '''
+        Register the media directories which were created before we maintained a manifest,
+        so we don't need to look at the filesystem to find them anymore.
+        '''
+        with self._dbenv.begin(db=self._mediadb) as txn:
+            if txn.get(b'\0') is not None:
+                return
+        if not self.media_dir:
+            return
+
+        log.info("Building media manifest")
+        root_depth = self.media_dir.rstrip('/').count('/') - 1
+        with self._dbenv.begin(db=self._mediadb, write=True) as txn:
+            for dirpath, dirs, files in os.walk(self.media_dir):
+                depth = dirpath.count('/') - root_depth
+                if depth < 6:
+                    # depth < 6 means we don't have enough parts for a full component-id
+                    continue
+                del dirs[:]
+                if depth > 6:
+                    continue
+
+                cptid = os.path.relpath(dirpath, self.media_dir)
+                component, gid = cptid.split('/', 1)
+                txn.put(tobytes(gid) + b'\0', tobytes(component))
+            txn.put(b'\0', b'')
+
+
+    def _remove_media(self, txn, gids):
+        '''
+        Drop the manifest entries of the given components, and return the
+        media directories which need to be deleted.
+        The stored files they were using are remembered as candidates for pruning.
+        '''
+        dirs = list()
+        for gid in gids:
+            prefix = tobytes(gid) + b'\0'
+            component = txn.get(prefix, db=self._mediadb)
+            if component is None:
+                continue
+            dirs.append(os.path.join(self.media_dir, str(component, 'utf-8'), str(gid, 'utf-8')))
+
+            tracked = False
+            for key, data in self._iter_prefix(txn.cursor(db=self._mediadb), prefix):
+                fields = str(data, 'utf-8').split('\n')
+                if len(fields) < 4 or not fields[3]:
+                    continue
+                tracked = True
+                txn.delete(self._media_ref_key(fields[3], key), db=self._mediarefsdb)
+                txn.put(b'\0' + tobytes(fields[3]), b'', db=self._mediarefsdb)
+            if not tracked:
+                # media from before we tracked the use of stored files, we need to
+                # look at the whole store to find out what is unused now
+                txn.delete(b'\0\0', db=self._mediarefsdb)
+
+            self._delete_prefix(txn, self._mediadb, prefix)
+        return dirs
+
+
+    def _prune_media_store(self):
+        '''
+        Remove the stored media files which are not used by any component anymore.
+        Only files which lost a user since the last run are looked at, unless media
+        which predates the tracking of stored files was removed.
+        '''
+        with self._dbenv.begin(db=self._mediarefsdb) as txn:
+            full_scan = txn.get(b'\0\0') is None
+            candidates = [key[1:] for key, value in self._iter_prefix(txn.cursor(), b'\0') if key != b'\0\0']
+
+        if full_scan:
+            self.media_store.prune()
+        else:
+            count = 0
+            with self._dbenv.begin(db=self._mediarefsdb) as txn:
+                cursor = txn.cursor()
+                for store_key in candidates:
+                    prefix = store_key + b'\0'
+                    if cursor.set_range(prefix) and cursor.key().startswith(prefix):
+                        continue
+                    if self.media_store.remove(str(store_key, 'utf-8')):
+                        count += 1
+            log.debug("Pruned %i files from media store" % (count))
+
+        with self._dbenv.begin(db=self._mediarefsdb, write=True) as txn:
+            for store_key in candidates:
+                txn.delete(b'\0' + store_key)
+            txn.put(b'\0\0', b'')
+
+
+    def _delete_media_dirs(self, dirs):
+        def delete_dir(d):
+            shutil.rmtree(d, ignore_errors=True)
+            # remove possibly empty directories
+            self._cleanup_empty_dirs(d)
+
+        # deleting many small directory trees is dominated by waiting for the filesystem
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for d in executor.map(delete_dir, dirs):
+                pass
 
 
     def remove_package(self, pkgid):
         log.debug("Dropping package: %s" % (pkgid))
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            pktxn.delete(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as htxn:
-            htxn.delete(pkgid)
+        self._set_gid_refs(pkgid, list())
+        self._delete(b'packages', pkgid)
+        self._delete(b'hints', pkgid)
+        self._drop_export_fragments(pkgid)
 
 
     def is_ignored(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            return txn.get(pkgid) == b'ignore'
+        return self._get(b'packages', pkgid) == b'ignore'
 
 
     def package_exists(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            return txn.get(pkgid) != None
+        return self._get(b'packages', pkgid) != None
 
 
     def get_packages_not_in_set(self, pkgset):
@@ -231,56 +748,35 @@ class DataCache:
         return res
 
 
-    def _remove_media_for_gid(self, gid):
-        if not self.media_dir:
-            return False
-        if not gid:
-            return False
-        dirs = glob.glob(os.path.join(self.media_dir, "*", gid))
-        if dirs:
-            shutil.rmtree(dirs[0])
-            # remove possibly empty directories
-            self._cleanup_empty_dirs(dirs[0])
-            return True
-
-
     def remove_orphaned_components(self):
         """
         Remove components from the database, which have no package
         associated with them.
+        Only components which lost a package reference since the last run are looked at.
         """
-        gid_pkg = dict()
-
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cursor = txn.cursor()
-            for key, value in cursor:
-                if not value or value == b'ignore' or value == b'seen':
-                    continue
-                value = str(value, 'utf-8')
-                gids = value.split("\n")
-                for gid in gids:
-                    if not gid_pkg.get(gid):
-                        gid_pkg[gid] = list()
-                    gid_pkg[gid].append(key)
-
-        # remove the media and component data, if component is orphaned
-        with self._dbenv.begin(db=self._datadb) as dtxn:
-            cursor = dtxn.cursor()
-            for gid, yaml in cursor:
-                gid = str(gid, 'utf-8')
+        self._ensure_media_manifest()
 
+        orphans = list()
+        with self._dbenv.begin(write=True) as txn:
+            cursor = txn.cursor(db=self._orphansdb)
+            for gid in cursor.iternext(values=False):
                 # Check if we have a package which is still referencing this component
-                pkgs = gid_pkg.get(gid)
-                if pkgs:
+                if self._has_gid_refs(txn, gid):
                     continue
 
-                # drop cached media
-                if self._remove_media_for_gid(gid):
-                    log.info("Expired media: %s" % (gid))
-
                 # drop component from db
-                with self._dbenv.begin(db=self._datadb, write=True) as dtxn:
-                    dtxn.delete(tobytes(gid))
+                txn.delete(gid, db=self._datadb)
+                txn.delete(self._report_fragment_key('mdata', gid), db=self._reportsdb)
+                self._drop_icon_tar_members(txn, gid)
+                orphans.append(gid)
+            txn.drop(self._orphansdb, delete=False)
+
+            # drop cached media
+            media_dirs = self._remove_media(txn, orphans)
+
+        self._delete_media_dirs(media_dirs)
+        for d in media_dirs:
+            log.info("Expired media: %s" % (os.path.relpath(d, self.media_dir)))
 
 
     def remove_orphaned_media(self):
@@ -290,31 +786,42 @@ class DataCache:
         """
         if not self.media_dir:
             return False
-
-        def list_cptdirs():
-            root_depth = self.media_dir.rstrip('/').count('/') - 1
-            for dirpath, dirs, files in os.walk(self.media_dir):
-                depth = dirpath.count('/') - root_depth
-                if depth < 6:
-                    # depth < 6 means we don't have enough parts for a full component-id
-                    continue
-                elif depth > 6:
-                    del dirs[:]
-                    continue
-
-                cptid = dirpath.replace(self.media_dir, "")
-                if cptid.startswith("/"):
-                    cptid = cptid[1:]
-                cptid = cptid[cptid.index('/')+1:]
-                if depth == 6:
-                    yield cptid.rstrip('/')
-
-        for cptid in list_cptdirs():
-            if not self.metadata_exists(cptid):
-                # on disk but not registered in cache?
-                # => remove it.
-                if self._remove_media_for_gid(cptid):
-                    log.info("Removed orphaned media: %s" % (cptid))
+        self._ensure_media_manifest()
+
+        with self._dbenv.begin(write=True) as txn:
+            # visit the directory entry of every component in the manifest
+            orphans = list()
+            cursor = txn.cursor(db=self._mediadb)
+            cursor.set_range(b'\0\0')
+            while cursor.key():
+                gid = cursor.key().split(b'\0', 1)[0]
+                if txn.get(gid, db=self._datadb) is None:
+                    # on disk but not registered in cache?
+                    # => remove it.
+                    orphans.append(gid)
+                    log.info("Removed orphaned media: %s" % (str(gid, 'utf-8')))
+                if not cursor.set_range(gid + b'\1'):
+                    break
+
+            media_dirs = self._remove_media(txn, orphans)
+
+        self._delete_media_dirs(media_dirs)
+
+        # drop stored media which is not used by any component anymore.
+        # This also removes screenshots which are not referenced by any global-id anymore.
+        self._prune_media_store()
+
+        # forget about screenshot downloads we do not have stored anymore
+        stale_urls = list()
+        with self._dbenv.begin(db=self._shotsdb) as txn:
+            cursor = txn.cursor()
+            for url, data in cursor:
+                checksum = str(data, 'utf-8').split('\n')[-1]
+                if not self.media_store.get(screenshot_key(checksum)):
+                    stale_urls.append(url)
+        with self._dbenv.begin(db=self._shotsdb, write=True) as txn:
+            for url in stale_urls:
+                txn.delete(url)
 
 
     def set_stats(self, timestamp, data):
@@ -338,31 +845,47 @@ class DataCache:
         return stats
 
 
+    def _iter_prefix(self, cursor, prefix):
+        '''
+        Yield all (key, value) pairs of the cursor's database with keys starting with prefix.
+        The keys are ordered, so we only need to visit the matching entries.
+        '''
+        if not cursor.set_range(prefix):
+            return
+        for key, value in cursor:
+            if not key.startswith(prefix):
+                break
+            yield key, value
+
+
+    def _delete_prefix(self, txn, db, prefix):
+        cursor = txn.cursor(db=db)
+        if not cursor.set_range(prefix):
+            return False
+        deleted = False
+        while cursor.key().startswith(prefix):
+            if not cursor.delete():
+                break
+            deleted = True
+        return deleted
+
+
     def delete_package_by_name(self, pkgname):
         """
         Remove all packages which have the given package name in all suites, architectures and
         of all versions in the cache.
         """
 
-        data_removed = False
-
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            cursor = pktxn.cursor()
-            for pkid, data in cursor:
-                pkid_str = str(pkid, 'utf-8')
-                if pkid_str.startswith(pkgname+'/'):
-                     pktxn.delete(pkid)
-                     data_removed = True
+        prefix = tobytes(pkgname + '/')
+        with self._dbenv.begin(db=self._pkgdb) as txn:
+            pkids = [pkid for pkid, data in self._iter_prefix(txn.cursor(), prefix)]
 
-        with self._dbenv.begin(db=self._hintsdb, write=True) as htxn:
-            cursor = htxn.cursor()
-            for pkid, data in cursor:
-                pkid_str = str(pkid, 'utf-8')
-                if pkid_str.startswith(pkgname+'/'):
-                     htxn.delete(pkid)
-                     data_removed = True
+        # remove_package() keeps the component references up to date for us
+        with self.write_batch():
+            for pkid in pkids:
+                self.remove_package(pkid)
 
-        return data_removed
+        return len(pkids) > 0
 
 
     def get_info(self, pkgname):
@@ -370,11 +893,8 @@ class DataCache:
         Return a dict with some information we have about the package in the cache.
         """
 
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
+        with self._dbenv.begin(db=self._pkgdb) as pktxn:
             cursor = pktxn.cursor()
-            for pkid, data in cursor:
-                pkid_str = str(pkid, 'utf-8')
-                data = str(data, 'utf-8')
-                if pkid_str.startswith(pkgname+'/'):
-                     pkkey = pkid_str.split("/", 1)[1]
-                     yield pkkey, data.split("\n")
+            for pkid, data in self._iter_prefix(cursor, tobytes(pkgname + '/')):
+                pkkey = str(pkid, 'utf-8').split("/", 1)[1]
+                yield pkkey, str(data, 'utf-8').split("\n")
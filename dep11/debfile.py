@@ -75,3 +75,68 @@ class DebFile:
             # we have a symlink, try to follow it
             self._deb.data.go(handle_data, symlink_target)
         return fdata
+
+
+    def get_files_data(self, fnames=(), predicate=None):
+        """
+        Extract data of multiple files from a .deb file with a single pass over
+        its payload, following symlinks.
+        If a predicate is given, all files whose path in the payload it accepts are
+        extracted as well.
+        Returns a dictionary mapping the requested filenames to their data. Files which
+        could not be found are not part of the result.
+        """
+
+        # map paths in the payload to the filenames they were requested as
+        wanted = dict()
+        for fname in fnames:
+            path = fname[1:] if fname.startswith('/') else fname
+            wanted.setdefault(path, set()).add(fname)
+
+        result = dict()
+        missed = dict()
+        def handle_data(member, data):
+            requested = wanted.get(member.name)
+            if not requested:
+                if not predicate or not predicate(member.name):
+                    return
+                requested = {member.name}
+            if member.issym():
+                symlink_target = member.linkname
+                if symlink_target.startswith('/'):
+                    # absolute path
+                    symlink_target = symlink_target[1:]
+                else:
+                    # relative path
+                    symlink_target = os.path.normpath(os.path.join(member.name, '..', symlink_target))
+                if symlink_target in seen:
+                    # we already passed the target, so we need to take another look at the payload
+                    missed.setdefault(symlink_target, set()).update(requested)
+                else:
+                    wanted.setdefault(symlink_target, set()).update(requested)
+                return
+            for fname in requested:
+                result[fname] = data
+
+        # (we use a dict to keep the order of files)
+        seen = dict()
+        def handle_member(member, data):
+            handle_data(member, data)
+            seen[member.name] = None
+
+        self._deb.data.go(handle_member)
+        # we walked over all files, so we got the list of files for free
+        if not self._filelist:
+            self._filelist = list(seen.keys())
+
+        # follow symlinks pointing backwards, but give up on long chains (or loops)
+        predicate = None
+        depth = 0
+        while missed and depth < 8:
+            wanted = dict(missed)
+            missed.clear()
+            seen.clear()
+            self._deb.data.go(handle_member)
+            depth += 1
+
+        return result
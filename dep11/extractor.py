@@ -17,15 +17,18 @@
 # License along with this program.
 
 import os
-import urllib.request
-import ssl
 import yaml
 
 from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import logging as log
 
 from .component import Component
 from .parsers import read_desktop_data, read_appstream_upstream_xml
+from .fetcher import get_media_fetcher
+from .mediastore import data_checksum, screenshot_key
+from .profiling import stage, count
 
 
 class MetadataExtractor:
@@ -33,104 +36,200 @@ class MetadataExtractor:
     Takes a deb file and extracts component metadata from it.
     '''
 
-    def __init__(self, suite_name, component, dcache, icon_handler):
+    def __init__(self, suite_name, component, dcache, icon_handler, package_index=None, arch_name=None):
         '''
         Initialize the object with List of files.
+        If a PackageIndex is given, package descriptions are read from it when they are needed,
+        from the data of the given architecture.
         '''
         self._suite_name = suite_name
         self._archive_component = component
+        self._arch_name = arch_name
         self._export_dir = dcache.media_dir
         self._dcache = dcache
         self.write_to_cache = True
 
         self._icon_handler = icon_handler
+        self._package_index = package_index
+
+
+    def _get_package_description(self, pkg):
+        if pkg.has_description():
+            return pkg.description
+        if not self._package_index:
+            return None
+        # arch:all packages are indexed under the architecture we are processing
+        arch_name = self._arch_name if self._arch_name else pkg.arch
+        return self._package_index.get_description(self._suite_name, self._archive_component, arch_name, pkg)
+
+
+    @property
+    def dcache(self):
+        return self._dcache
 
 
     def reopen_cache(self):
         self._dcache.reopen()
 
 
-    def _scale_screenshot(self, shot, imgsrc, cpt_export_path, cpt_scr_url):
+    def _scale_screenshot(self, shot, img, checksum, name, cpt_export_path, cpt_scr_url):
         """
         Scale images in three sets of two-dimensions
         (752x423 624x351 and 112x63)
+        Returns (size, filename) tuples for all thumbnails.
         """
 
-        name = os.path.basename(imgsrc)
+        store = self._dcache.media_store
         sizes = ['1248x702', '752x423', '624x351', '112x63']
+
+        thumbnails = list()
+        missing = set()
         for size in sizes:
             wd, ht = size.split('x')
-            img = Image.open(imgsrc)
-            newimg = img.resize((int(wd), int(ht)), Image.ANTIALIAS)
+            if int(wd) > img.width or int(ht) > img.height:
+                # never upscale screenshots
+                continue
             newpath = os.path.join(cpt_export_path, size)
             if not os.path.exists(newpath):
                 os.makedirs(newpath)
-            newimg.save(os.path.join(newpath, name))
+            thumb_fname = os.path.join(newpath, name)
+            thumbnails.append((size, thumb_fname))
+
+            # reuse thumbnails we already generated from the same image
+            if not store.link_to(screenshot_key(checksum, size), thumb_fname):
+                missing.add(size)
+
             url = "%s/%s/%s" % (cpt_scr_url, size, name)
             shot.add_thumbnail(url, width=wd, height=ht)
 
-    def _fetch_screenshots(self, cpt, cpt_export_path, cpt_public_url=""):
+        if not missing:
+            return thumbnails
+
+        def save_thumbnail(thumb, size, fname):
+            # the file might still be a link to a different stored image
+            if os.path.lexists(fname):
+                os.remove(fname)
+            thumb.save(fname)
+            store.add(screenshot_key(checksum, size), fname)
+
+        # we scale down step by step from the largest size, and let the (comparably slow)
+        # encoding of the images happen in parallel
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            jobs = list()
+            for size, thumb_fname in thumbnails:
+                wd, ht = size.split('x')
+                img = img.resize((int(wd), int(ht)), Image.ANTIALIAS)
+                if size in missing:
+                    jobs.append(executor.submit(save_thumbnail, img, size, thumb_fname))
+
+            for job in jobs:
+                job.result()
+
+        return thumbnails
+
+
+    def _request_screenshots(self, cpt):
+        '''
+        Start downloading the screenshots of the given component in the background.
+        Returns a list of (screenshot, future) tuples, which can be passed to _fetch_screenshots()
+        '''
+
+        fetcher = get_media_fetcher()
+        requests = list()
+        for shot in cpt.screenshots:
+            origin_url = shot.source_image['url']
+            if not origin_url:
+                # url empty? skip this screenshot
+                continue
+
+            # only fetch the screenshot again if it was modified since we downloaded it
+            # the last time, and we still have the previous version
+            etag = None
+            last_modified = None
+            info = self._dcache.get_screenshot_info(origin_url)
+            if info and self._dcache.media_store.get(screenshot_key(info['checksum'])):
+                etag = info['etag']
+                last_modified = info['last_modified']
+
+            requests.append((shot, fetcher.fetch(origin_url, etag, last_modified)))
+        return requests
+
+
+    def _fetch_screenshots(self, cpt, cpt_export_path, cpt_public_url="", requests=None):
         '''
         Fetches screenshots from the given url and
         stores it in png format.
+        Screenshots are kept in the media store by the checksum of their data, so we
+        only process the same image once, even if it is used by many components.
         '''
 
         if not cpt.screenshots:
             # don't ignore metadata if no screenshots are present
             return True
 
+        if requests is None:
+            requests = self._request_screenshots(cpt)
+
+        store = self._dcache.media_store
         success = True
         shots = list()
         cnt = 1
-        for shot in cpt.screenshots:
+        for shot, future in requests:
             # cache some locations which we need later
             origin_url = shot.source_image['url']
-            if not origin_url:
-                # url empty? skip this screenshot
-                continue
             path     = cpt.build_media_path(cpt_export_path, "screenshots")
             base_url = cpt.build_media_path(cpt_public_url,  "screenshots")
             imgsrc   = os.path.join(path, "source", "scr-%s.png" % (str(cnt)))
 
-            # The Debian services use a custom setup for SSL verification, not trusting global CAs and
-            # only Debian itself. If we are running on such a setup, ensure we load the global CA certs
-            # in order to establish HTTPS connections to foreign services.
-            # For more information, see https://wiki.debian.org/ServicesSSL
-            context = None
-            ca_path = '/etc/ssl/ca-global'
-            if os.path.isdir(ca_path):
-                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, capath=ca_path)
-            else:
-                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            result = future.result()
+            if result.error:
+                cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': result.error})
+                success = False
+                continue
 
+            etag = result.etag
+            last_modified = result.last_modified
             try:
-                # FIXME: The context parameter is only supported since Python 3.4.3, which is not
-                # yet widely available, so we can't use it here...
-                #! image = urllib.request.urlopen(origin_url, context=ssl_context).read()
-                image_req = urllib.request.urlopen(origin_url, timeout=30)
-                if image_req.getcode() != 200:
-                    msg = "HTTP status code was %i." % (image_req.getcode())
-                    cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': msg})
-                    success = False
-                    continue
+                if result.not_modified:
+                    # we have the data of the previous download in our store
+                    info = self._dcache.get_screenshot_info(origin_url)
+                    checksum = info['checksum']
+                    if not etag and not last_modified:
+                        etag = info['etag']
+                        last_modified = info['last_modified']
+                else:
+                    checksum = data_checksum(result.data)
+                    count('bytes-downloaded', len(result.data))
 
                 if not os.path.exists(os.path.dirname(imgsrc)):
                     os.makedirs(os.path.dirname(imgsrc))
-                f = open(imgsrc, 'wb')
-                f.write(image_req.read())
-                f.close()
+                if not store.link_to(screenshot_key(checksum), imgsrc):
+                    if result.data is None:
+                        raise Exception("The previously downloaded screenshot is not available anymore.")
+                    # the file might still be a link to a different stored image
+                    if os.path.lexists(imgsrc):
+                        os.remove(imgsrc)
+                    with open(imgsrc, 'wb') as f:
+                        f.write(result.data)
+                    store.add(screenshot_key(checksum), imgsrc)
             except Exception as e:
                 cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': str(e)})
                 success = False
                 continue
 
+            # remember the files we created, so they can be found without looking at the filesystem
+            self._dcache.add_media(cpt.global_id, self._archive_component, 'screenshot', imgsrc,
+                                   store_key=screenshot_key(checksum))
+
+            # opening the image only reads its header, it is only decoded if we need to scale it
+            stream = BytesIO(result.data) if result.data is not None else imgsrc
             try:
-                img = Image.open(imgsrc)
+                img = Image.open(stream)
                 wd, ht = img.size
                 shot.set_source_image(os.path.join(base_url, "source", "scr-%s.png" % (str(cnt))), width=wd, height=ht)
-                del img
             except Exception as e:
-                error_msg = str(e)
+                # refer to the file we stored instead of the in-memory stream
+                error_msg = str(e).replace(repr(stream), repr(imgsrc))
                 # filter out the absolute path: we shouldn't add it
                 if error_msg:
                     error_msg = error_msg.replace(os.path.dirname(imgsrc), "")
@@ -138,7 +237,14 @@ class MetadataExtractor:
                 success = False
                 continue
 
-            self._scale_screenshot(shot, imgsrc, path, base_url)
+            self._dcache.set_screenshot_info(origin_url, etag, last_modified, checksum)
+
+            thumbnails = self._scale_screenshot(shot, img, checksum, os.path.basename(imgsrc), path, base_url)
+            del img
+
+            for size, thumb_fname in thumbnails:
+                self._dcache.add_media(cpt.global_id, self._archive_component, 'screenshot-thumbnail', thumb_fname,
+                                       store_key=screenshot_key(checksum, size))
             shots.append(shot)
             cnt = cnt + 1
 
@@ -146,7 +252,15 @@ class MetadataExtractor:
         return success
 
 
-    def _process_pkg(self, pkg, metainfo_files=None):
+    def _is_desktop_file(self, fname):
+        return fname.endswith(".desktop") and fname.startswith("usr/share/applications")
+
+
+    def _is_metainfo_file(self, fname):
+        return fname.endswith(".xml") and (fname.startswith("usr/share/metainfo") or fname.startswith("usr/share/appdata"))
+
+
+    def _process_pkg(self, pkg):
         """
         Reads the metadata from the xml file and the desktop files.
         Returns a list of processed dep11.Component objects.
@@ -159,8 +273,13 @@ class MetadataExtractor:
             log.error("Error reading deb file '%s': %s" % (pkg.filename, e))
             return list()
 
+        # extract all the files we are interested in with a single pass over the package payload,
+        # which gives us the complete list of files as well
         try:
-            filelist = deb.get_filelist()
+            with stage('deb-extract'):
+                files_data = deb.get_files_data(predicate=lambda f: self._is_desktop_file(f) or self._is_metainfo_file(f))
+                filelist = deb.get_filelist()
+            count('bytes-read', sum(len(data) for data in files_data.values() if data))
         except Exception as e:
             log.error("List of files for '%s' could not be read" % (pkg.filename))
             filelist = None
@@ -173,21 +292,24 @@ class MetadataExtractor:
         export_path = "%s/%s" % (self._export_dir, self._archive_component)
         component_dict = dict()
 
-        # if we don't have an explicit list of interesting files, we simply scan all
-        if not metainfo_files:
-            metainfo_files = filelist
+        def get_file_content(fname):
+            data = files_data.get(fname)
+            if data is None:
+                # e.g. a dangling symlink
+                return None
+            return str(data, 'utf-8')
 
         # first cache all additional metadata (.desktop/.pc/etc.) files
         mdata_raw = dict()
-        for meta_file in metainfo_files:
-            if meta_file.endswith(".desktop") and meta_file.startswith("usr/share/applications"):
+        for meta_file in filelist:
+            if self._is_desktop_file(meta_file):
                 # We have a .desktop file
                 dcontent = None
                 cpt_id = os.path.basename(meta_file)
 
                 error = None
                 try:
-                    dcontent = str(deb.get_file_data(meta_file), 'utf-8')
+                    dcontent = get_file_content(meta_file)
                 except Exception as e:
                     error = {'tag': "deb-extract-error",
                                 'params': {'fname': cpt_id, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)}}
@@ -197,13 +319,13 @@ class MetadataExtractor:
                 mdata_raw[cpt_id] = {'error': error, 'data': dcontent}
 
         # process all AppStream XML files
-        for meta_file in metainfo_files:
-            if meta_file.endswith(".xml") and (meta_file.startswith("usr/share/metainfo") or meta_file.startswith("usr/share/appdata")):
+        for meta_file in filelist:
+            if self._is_metainfo_file(meta_file):
                 xml_content = None
                 cpt = Component(self._suite_name, pkg)
 
                 try:
-                    xml_content = str(deb.get_file_data(meta_file), 'utf-8')
+                    xml_content = get_file_content(meta_file)
                 except Exception as e:
                     # inability to read an AppStream XML file is a valid reason to skip the whole package
                     cpt.add_hint("deb-extract-error", {'fname': meta_file, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)})
@@ -211,7 +333,8 @@ class MetadataExtractor:
                 if not xml_content:
                     continue
 
-                read_appstream_upstream_xml(cpt, xml_content)
+                with stage('metadata-parse'):
+                    read_appstream_upstream_xml(cpt, xml_content)
                 component_dict[cpt.cid] = cpt
 
                 # Reads the desktop files associated with the xml file
@@ -232,7 +355,8 @@ class MetadataExtractor:
                     else:
                         # we have a .desktop component, extend it with the associated .desktop data
                         # if a metainfo file exists, we should ignore NoDisplay flags in .desktop files.
-                        read_desktop_data(cpt, data['data'], ignore_nodisplay=True)
+                        with stage('metadata-parse'):
+                            read_desktop_data(cpt, data['data'], ignore_nodisplay=True)
                         cpt.set_srcdata_checksum_from_data(xml_content + data['data'] + pkg.version)
                     del mdata_raw[cpt.cid]
 
@@ -248,7 +372,8 @@ class MetadataExtractor:
                     cpt.add_hint(mdata['error']['tag'], mdata['error']['params'])
                     component_dict[cpt.cid] = cpt
                 else:
-                    ret = read_desktop_data(cpt, mdata['data'])
+                    with stage('metadata-parse'):
+                        ret = read_desktop_data(cpt, mdata['data'])
                     if ret or not cpt.has_ignore_reason():
                         component_dict[cpt.cid] = cpt
                         cpt.set_srcdata_checksum_from_data(mdata['data'] + pkg.version)
@@ -259,6 +384,9 @@ class MetadataExtractor:
 
         # fetch media (icons/screenshots), if we don't ignore the component already
         cpts = component_dict.values()
+        shot_requests = dict()
+        # the components we fetched media for
+        media_cpts = list()
         for cpt in cpts:
             if cpt.has_ignore_reason():
                 continue
@@ -286,29 +414,42 @@ class MetadataExtractor:
                     cpt.add_hint("metainfo-duplicate-id", {'cid': cpt.cid, 'pkgname': ecpt.get('Package', '')})
                     continue
 
-            self._icon_handler.fetch_icon(cpt, pkg, export_path)
+            # this includes reading the icon data from the packages
+            with stage('icons'):
+                self._icon_handler.fetch_icon(cpt, pkg, export_path)
             if cpt.kind == 'desktop-app' and not cpt.has_icon():
                 cpt.add_hint("gui-app-without-icon", {'cid': cpt.cid})
-            else:
-                self._fetch_screenshots(cpt, export_path)
+            elif cpt.screenshots:
+                # download the screenshots in the background while we look at the other components
+                with stage('screenshots'):
+                    shot_requests[cpt.cid] = self._request_screenshots(cpt)
+            media_cpts.append(cpt)
+
+        for cpt in media_cpts:
+            requests = shot_requests.get(cpt.cid)
+            if requests is not None:
+                # wait for the downloads we started above
+                with stage('screenshots'):
+                    self._fetch_screenshots(cpt, export_path, requests=requests)
 
             # Since not all software ships a metainfo file yet, we add the package description as metadata to those
             # which don't, to get them to show up in software centers.
             # In the long run, this functionality will be phased out in favor of an all-metainfo approach.
             if not cpt.description and not cpt.has_ignore_reason():
-                if pkg.has_description():
-                    cpt.description = pkg.description
+                desc = self._get_package_description(pkg)
+                if desc:
+                    cpt.description = desc
                     cpt.add_hint("description-from-package")
 
         return cpts
 
-    def process(self, pkg, metainfo_files=None):
+    def process(self, pkg):
         """
         Reads the metadata from the xml file and the desktop files.
         Returns a list of dep11.Component objects, and writes the result to the cache.
         """
 
-        cpts = self._process_pkg(pkg, metainfo_files)
+        cpts = self._process_pkg(pkg)
 
         # build the package unique identifier (again)
         # NOTE: We could also get this from any returned component (pkid property)
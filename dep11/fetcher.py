@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import ssl
+import time
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+
+__all__ = list()
+
+# time in seconds until we give up waiting for a remote host
+FETCH_TIMEOUT = 30
+# number of attempts to download a file, in case of network errors
+FETCH_ATTEMPTS = 3
+# maximum number of redirects we follow
+MAX_REDIRECTS = 5
+# maximum number of concurrent downloads, and concurrent connections per host.
+# If a FetchService is used, these limits are shared by all processes using it.
+MAX_FETCH_THREADS = 8
+MAX_CONNECTIONS_PER_HOST = 2
+
+
+def _create_ssl_context():
+    # The Debian services use a custom setup for SSL verification, not trusting global CAs and
+    # only Debian itself. If we are running on such a setup, ensure we load the global CA certs
+    # in order to establish HTTPS connections to foreign services.
+    # For more information, see https://wiki.debian.org/ServicesSSL
+    ca_path = '/etc/ssl/ca-global'
+    if os.path.isdir(ca_path):
+        return ssl.create_default_context(capath=ca_path)
+    return ssl.create_default_context()
+
+
+class FetchResult:
+    '''
+    The result of a download.
+    If the remote file was not modified since the validators passed to the fetcher
+    were obtained, "not_modified" is set and no data is returned.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.data = None
+        self.not_modified = False
+        self.etag = None
+        self.last_modified = None
+        self.error = None
+
+__all__.append('FetchResult')
+
+
+class _HostConnections:
+    '''
+    Idle connections to a host, and the limit of concurrent connections to it.
+    '''
+
+    def __init__(self, max_connections):
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = list()
+        self.lock = threading.Lock()
+
+
+class MediaFetcher:
+    '''
+    Downloads files using a pool of threads.
+
+    Connections are kept alive and reused for later requests to the same host. The
+    number of concurrent connections per host is limited, so we are nice to upstream
+    servers, and a single slow host does not stall all other downloads.
+    '''
+
+    def __init__(self, max_threads=MAX_FETCH_THREADS, max_per_host=MAX_CONNECTIONS_PER_HOST):
+        self._executor = ThreadPoolExecutor(max_workers=max_threads)
+        self._max_per_host = max_per_host
+        self._hosts = dict()
+        self._hosts_lock = threading.Lock()
+        self._ssl_context = _create_ssl_context()
+        self._proxies = urllib.request.getproxies()
+
+
+    def _get_host(self, key):
+        with self._hosts_lock:
+            host = self._hosts.get(key)
+            if not host:
+                host = _HostConnections(self._max_per_host)
+                self._hosts[key] = host
+            return host
+
+
+    def _route(self, url):
+        '''
+        Returns the key of the host we need to connect to for the given URL, and the
+        path we need to request from it.
+        '''
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported URL scheme '%s'." % (parts.scheme))
+        if not parts.hostname:
+            raise ValueError("URL has no host.")
+        port = parts.port
+        if not port:
+            port = 443 if parts.scheme == 'https' else 80
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        proxy = self._proxies.get(parts.scheme)
+        if proxy and urllib.request.proxy_bypass(parts.hostname):
+            proxy = None
+        if proxy and parts.scheme == 'http':
+            # plain HTTP proxies want the full URL
+            path = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+
+        return (parts.scheme, parts.hostname, port, proxy), path
+
+
+    def _connect(self, key):
+        scheme, hostname, port, proxy = key
+        if proxy:
+            pparts = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(pparts.hostname, pparts.port or 80,
+                                                   timeout=FETCH_TIMEOUT, context=self._ssl_context)
+                conn.set_tunnel(hostname, port)
+                return conn
+            return http.client.HTTPConnection(pparts.hostname, pparts.port or 80, timeout=FETCH_TIMEOUT)
+
+        if scheme == 'https':
+            return http.client.HTTPSConnection(hostname, port, timeout=FETCH_TIMEOUT, context=self._ssl_context)
+        return http.client.HTTPConnection(hostname, port, timeout=FETCH_TIMEOUT)
+
+
+    def _request(self, url, headers):
+        key, path = self._route(url)
+        host = self._get_host(key)
+
+        with host.slots:
+            conn = None
+            with host.lock:
+                if host.idle:
+                    conn = host.idle.pop()
+            if not conn:
+                conn = self._connect(key)
+
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                # always read the whole response, so the connection can be reused
+                data = response.read()
+            except:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                with host.lock:
+                    host.idle.append(conn)
+
+        return response, data
+
+
+    def _fetch(self, url, etag, last_modified):
+        result = FetchResult(url)
+
+        headers = {'Accept-Encoding': 'identity'}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        attempt = 1
+        redirects = 0
+        while True:
+            try:
+                response, data = self._request(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                # network issue or a kept-alive connection closed by the server, try again
+                if attempt >= FETCH_ATTEMPTS:
+                    result.error = str(e)
+                    return result
+                log.debug("Download of '%s' failed, retrying: %s" % (url, str(e)))
+                time.sleep(attempt)
+                attempt += 1
+                continue
+            except Exception as e:
+                result.error = str(e)
+                return result
+
+            status = response.status
+            if status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                redirects += 1
+                if not location or redirects > MAX_REDIRECTS:
+                    result.error = "Too many redirects, or redirect without location."
+                    return result
+                url = urllib.parse.urljoin(url, location)
+                continue
+
+            if status >= 500 and attempt < FETCH_ATTEMPTS:
+                time.sleep(attempt)
+                attempt += 1
+                continue
+
+            if status == 304:
+                result.not_modified = True
+            elif status == 200:
+                result.data = data
+            else:
+                result.error = "HTTP status code was %i." % (status)
+                return result
+
+            result.etag = response.getheader('ETag')
+            result.last_modified = response.getheader('Last-Modified')
+            return result
+
+
+    def fetch(self, url, etag=None, last_modified=None):
+        '''
+        Start downloading the given URL, and return a future for its FetchResult.
+        If "etag" or "last_modified" are set, the file is only downloaded if it
+        has been modified since.
+        '''
+        return self._executor.submit(self._fetch, url, etag, last_modified)
+
+
+    def close(self):
+        '''
+        Wait for all downloads to complete, and close all connections.
+        '''
+        self._executor.shutdown()
+        with self._hosts_lock:
+            for host in self._hosts.values():
+                with host.lock:
+                    for conn in host.idle:
+                        conn.close()
+                    host.idle.clear()
+
+__all__.append('MediaFetcher')
+
+
+class FetchService:
+    '''
+    Downloads files on behalf of other processes.
+
+    The service is run in its own process by a FetchManager, so all processes using it
+    share one MediaFetcher, and with it the limits of concurrent downloads and
+    connections per host.
+    Downloads are identified by a ticket, which is used to collect their result.
+    '''
+
+    def __init__(self, max_threads=MAX_FETCH_THREADS, max_per_host=MAX_CONNECTIONS_PER_HOST):
+        self._fetcher = MediaFetcher(max_threads, max_per_host)
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._next_ticket = 0
+
+
+    def fetch(self, url, etag=None, last_modified=None):
+        '''
+        Start downloading the given URL, and return the ticket of the download.
+        '''
+        future = self._fetcher.fetch(url, etag, last_modified)
+        with self._lock:
+            self._next_ticket += 1
+            ticket = self._next_ticket
+            self._futures[ticket] = future
+        return ticket
+
+
+    def result(self, ticket):
+        '''
+        Wait for the download with the given ticket to complete, and return its FetchResult.
+        '''
+        with self._lock:
+            future = self._futures.pop(ticket)
+        return future.result()
+
+__all__.append('FetchService')
+
+
+class FetchManager(BaseManager):
+    '''
+    Runs a FetchService in a separate process.
+    '''
+    pass
+
+FetchManager.register('FetchService', FetchService)
+
+__all__.append('FetchManager')
+
+
+class _RemoteFetch:
+    '''
+    A download running in a FetchService, behaving like a future of its FetchResult.
+    '''
+
+    def __init__(self, service, ticket):
+        self._service = service
+        self._ticket = ticket
+        self._result = None
+
+
+    def result(self):
+        if self._result is None:
+            self._result = self._service.result(self._ticket)
+        return self._result
+
+
+class RemoteMediaFetcher:
+    '''
+    Works like a MediaFetcher, but lets a FetchService do the downloads.
+    The process only sends the URLs to the service, so it can continue with
+    other work while the files are downloaded.
+    '''
+
+    def __init__(self, service):
+        self._service = service
+
+
+    def fetch(self, url, etag=None, last_modified=None):
+        return _RemoteFetch(self._service, self._service.fetch(url, etag, last_modified))
+
+__all__.append('RemoteMediaFetcher')
+
+
+_media_fetcher = None
+
+def set_media_fetcher(fetcher):
+    '''
+    Set the fetcher which is used by everything in this process, e.g. a
+    RemoteMediaFetcher to share a FetchService with other processes.
+    '''
+    global _media_fetcher
+    _media_fetcher = fetcher
+
+__all__.append('set_media_fetcher')
+
+
+def get_media_fetcher():
+    '''
+    Return the fetcher which is shared by everything in this process.
+    If none was set, a MediaFetcher for this process alone is created.
+    '''
+    global _media_fetcher
+    if not _media_fetcher:
+        _media_fetcher = MediaFetcher()
+    return _media_fetcher
+
+__all__.append('get_media_fetcher')
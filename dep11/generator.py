@@ -21,7 +21,11 @@ import apt_pkg
 import gzip
 import tarfile
 import glob
+import queue
+import random
+import tempfile
 import traceback
+from io import BytesIO
 from argparse import ArgumentParser
 import multiprocessing as mp
 import logging as log
@@ -30,9 +34,11 @@ from dep11 import DataCache, MetadataExtractor
 from .component import get_dep11_header
 from .iconhandler import IconHandler
 from .utils import load_generator_config
-from .package import read_packages_dict_from_file
+from .package import Package, PackageIndex
 from .reportgenerator import ReportGenerator
-from .contentsfile import parse_contents_file
+from .contentsfile import ContentsIndex
+from .profiling import RunReport, timed_package
+from .fetcher import FetchManager, RemoteMediaFetcher, set_media_fetcher
 
 
 def safe_move_file(old_fname, new_fname):
@@ -43,13 +49,53 @@ def safe_move_file(old_fname, new_fname):
     os.rename(old_fname, new_fname)
 
 
-def extract_metadata(mde, sn, pkg):
-    # we're now in a new process and can (re)open a LMDB connection
-    mde.reopen_cache()
-    cpts = mde.process(pkg)
+def add_tar_file(tar, fname, arcname):
+    '''
+    Add a file to a tarball, always as a regular file.
+    Our media files are hardlinks into the media store, so tarfile would store
+    files it has seen before as links to members which may not even be part of the
+    tarball the client unpacks.
+    '''
+    tarinfo = tar.gettarinfo(fname, arcname=arcname)
+    tarinfo.type = tarfile.REGTYPE
+    tarinfo.linkname = ""
+    tarinfo.size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        tar.addfile(tarinfo, f)
+
+
+# the metadata extractors of a worker process, by (component, arch)
+_worker_extractors = None
+
+def init_extract_worker(extractors, fetch_service):
+    global _worker_extractors
+    _worker_extractors = extractors
+
+    # all workers download screenshots through the same service, so the download
+    # limits apply to all of them together
+    set_media_fetcher(RemoteMediaFetcher(fetch_service))
+
+    # we're now in a new process and can (re)open a LMDB connection.
+    # All extractors share the same cache object, so this worker only has one.
+    for mde in extractors.values():
+        mde.reopen_cache()
+
+
+def extract_metadata(key, sn, pkid, fname):
+    mde = _worker_extractors[key]
+    name, version, arch = pkid.split('/')
+    pkg = Package(name, version, arch, fname)
+
+    # we don't write to the database here, the main process commits
+    # our data together with the results of other packages
+    with timed_package() as timer:
+        mde.dcache.begin_batch()
+        cpts = mde.process(pkg)
+        cache_writes = mde.dcache.take_batch()
+        timings = timer.to_dict()
 
     msgtxt = "Processed ({0}/{1}): %s (%s/%s), found %i" % (pkg.name, sn, pkg.arch, len(cpts))
-    return (msgtxt, all(not x.has_ignore_reason() for x in cpts))
+    return (msgtxt, all(not x.has_ignore_reason() for x in cpts), cache_writes, pkid, timings)
 
 
 class DEP11Generator:
@@ -71,6 +117,12 @@ class DEP11Generator:
 
         self._archive_root = conf.get("ArchiveRoot")
 
+        # amount of packages we write to the cache in one transaction
+        self._cache_batch_size = conf.get("CacheBatchSize", 100)
+
+        # assemble the exported data from compressed per-package fragments stored in the cache
+        self._incremental_export = conf.get("IncrementalExport", False)
+
         cache_dir = os.path.join(dep11_dir, "cache")
         if conf.get("CacheDir"):
             cache_dir = conf.get("CacheDir")
@@ -101,6 +153,14 @@ class DEP11Generator:
         self._cache = DataCache(self._get_media_dir())
         ret = self._cache.open(cache_dir)
 
+        # index of the archive Packages files, so we only parse them if they changed
+        self._package_index = PackageIndex()
+        self._package_index.open(os.path.join(cache_dir, "packages"))
+
+        # index of the archive Contents files, shared by everything which needs Contents data
+        self._contents_index = ContentsIndex(self._package_index)
+        self._contents_index.open(os.path.join(cache_dir, "contents"))
+
         os.chdir(dep11_dir)
         return ret
 
@@ -112,8 +172,65 @@ class DEP11Generator:
         return mdir
 
 
-    def _get_packages_for(self, suite, component, arch, with_desc=True):
-        return read_packages_dict_from_file(self._archive_root, suite, component, arch, with_description=with_desc).values()
+    def _get_packages_for(self, suite, component, arch):
+        # descriptions are read from the package index by the extractor if they are needed
+        return self._package_index.get_packages(self._archive_root, suite, component, arch).values()
+
+
+    def _build_icon_tar_member(self, component, gid, size, names_seen=None):
+        '''
+        Return the icons of the given size of a component, and their data as a gzip
+        member containing a tar stream without end-of-archive marker.
+        '''
+        icon_location_glob = os.path.join(self._get_media_dir(), component, gid, "icons", size, "*.png")
+
+        names = list()
+        tar_data = BytesIO()
+        tar = tarfile.open(fileobj=tar_data, mode="w")
+        for filename in sorted(glob.glob(icon_location_glob)):
+            icon_name = os.path.basename(filename)
+            if names_seen and size+"/"+icon_name in names_seen:
+                continue
+            add_tar_file(tar, filename, icon_name)
+            names.append(icon_name)
+
+        # we take the data before closing the archive, so the members can be concatenated
+        member = gzip.compress(tar_data.getvalue()) if names else b''
+        tar.close()
+        return names, member
+
+
+    def _make_icon_tar_incremental(self, suitename, component, gids):
+        '''
+        Assemble icons-%(size).tar.gz from compressed tar members of every
+        component, which we store in the cache.
+        '''
+        tar_location = os.path.join(self._export_dir, "data", suitename, component)
+
+        for size in self._icon_sizes:
+            icon_tar_fname = os.path.join(tar_location, "icons-%s.tar.gz" % (size))
+            names_seen = set()
+
+            with open(icon_tar_fname+".new", 'wb') as f:
+                for gid in gids:
+                    res = self._cache.get_icon_tar_member(gid, size)
+                    if res is None:
+                        res = self._build_icon_tar_member(component, gid, size)
+                        self._cache.set_icon_tar_member(gid, size, res[0], res[1])
+                    names, member = res
+                    if not names:
+                        continue
+
+                    if any(size+"/"+name in names_seen for name in names):
+                        # we can't use the stored data, as an icon with the same name exists already
+                        names, member = self._build_icon_tar_member(component, gid, size, names_seen)
+                    f.write(member)
+                    for name in names:
+                        names_seen.add(size+"/"+name)
+
+                # end-of-archive marker
+                f.write(gzip.compress(bytes(tarfile.BLOCKSIZE * 2)))
+            safe_move_file(icon_tar_fname+".new", icon_tar_fname)
 
 
     def make_icon_tar(self, suitename, component, pkglist):
@@ -124,6 +241,16 @@ class DEP11Generator:
         names_seen = set()
         tar_location = os.path.join(self._export_dir, "data", suitename, component)
 
+        if self._incremental_export:
+            gids = list()
+            for pkg in pkglist:
+                gids.extend(self._cache.get_cpt_gids_for_pkg(pkg.pkid) or [])
+            # the builds of a package for all architectures share the same components
+            gids = list(dict.fromkeys(gids))
+            if gids:
+                self._make_icon_tar_incremental(suitename, component, gids)
+            return
+
         size_tars = dict()
 
         for pkg in pkglist:
@@ -148,7 +275,7 @@ class DEP11Generator:
                         icon_name = os.path.basename(filename)
                         if size+"/"+icon_name in names_seen:
                             continue
-                        tar.add(filename, arcname=icon_name)
+                        add_tar_file(tar, filename, icon_name)
                         names_seen.add(size+"/"+icon_name)
 
         for tar in size_tars.values():
@@ -157,6 +284,204 @@ class DEP11Generator:
             safe_move_file(tar.name, tar.name.replace(".new", ""))
 
 
+    def _get_metainfo_files(self, suite_name, component, arch):
+        '''
+        Return a dict mapping package names to the list of .desktop and metainfo files
+        they contain, according to the Contents data, or None if we have no Contents data.
+        '''
+        if not self._contents_index.update(self._archive_root, suite_name, component, arch):
+            return None
+
+        metainfo_files = dict()
+        for prefix in ['usr/share/applications/', 'usr/share/metainfo/', 'usr/share/appdata/']:
+            for fname, pkgname in self._contents_index.get_files(suite_name, component, arch, prefix):
+                if fname.endswith(".desktop") or fname.endswith(".xml"):
+                    metainfo_files.setdefault(pkgname, list()).append(fname)
+        return metainfo_files
+
+
+    def _get_export_fragment(self, kind, pkid):
+        '''
+        Return the data of the given kind for a package as gzip member, compressing
+        it only if we didn't export it before.
+        '''
+        fragment = self._cache.get_export_fragment(kind, pkid)
+        if fragment is not None:
+            return fragment
+
+        if kind == 'data':
+            data = self._cache.get_metadata_for_pkg(pkid)
+        else:
+            data = self._cache.get_hints(pkid)
+        fragment = gzip.compress(bytes(data, 'utf-8')) if data else b''
+        self._cache.set_export_fragment(kind, pkid, fragment)
+        return fragment
+
+
+    def _write_arch_data_incremental(self, hints_fname, data_fname, dep11_header, pkglist):
+        '''
+        Assemble the metadata and hints files from compressed per-package fragments
+        in the cache, so only data of new packages needs to be compressed.
+        The resulting files consist of multiple gzip members.
+        '''
+
+        if data_fname:
+            data_f = open(data_fname+".new", 'wb')
+            data_f.write(gzip.compress(bytes(dep11_header, 'utf-8')))
+        hints_f = open(hints_fname+".new", 'wb')
+        # ensure the hints file is valid gzip data even if there are no hints
+        hints_f.write(gzip.compress(b''))
+
+        for pkg in pkglist:
+            pkid = pkg.pkid
+            if data_fname:
+                data_f.write(self._get_export_fragment('data', pkid))
+            hints_f.write(self._get_export_fragment('hints', pkid))
+
+        if data_fname:
+            data_f.close()
+            safe_move_file(data_fname+".new", data_fname)
+
+        hints_f.close()
+        safe_move_file(hints_fname+".new", hints_fname)
+
+
+    def _write_arch_data(self, suite_name, suite, component, arch, pkglist, new_components):
+        '''
+        Export the metadata and hints of an architecture to disk.
+        '''
+
+        hints_dir = os.path.join(self._export_dir, "hints", suite_name, component)
+        if not os.path.exists(hints_dir):
+            os.makedirs(hints_dir)
+        hints_fname = os.path.join(hints_dir, "DEP11Hints_%s.yml.gz" % (arch))
+
+        dep11_header = get_dep11_header(self._repo_name, suite_name, component, os.path.join(self._dep11_url, component), suite.get('dataPriority', 0))
+
+        dep11_dir = os.path.join(self._export_dir, "data", suite_name, component)
+        if not os.path.exists(dep11_dir):
+            os.makedirs(dep11_dir)
+
+        data_fname = None
+        if not new_components:
+            log.info("Skipping %s/%s/%s, no components in any of the new packages.", suite_name, component, arch)
+        else:
+            data_fname = os.path.join(dep11_dir, "Components-%s.yml.gz" % (arch))
+
+        if self._incremental_export:
+            self._write_arch_data_incremental(hints_fname, data_fname, dep11_header, pkglist)
+            return
+
+        hints_f = gzip.open(hints_fname+".new", 'wb')
+        if new_components:
+            # now write data to disk
+            data_f = gzip.open(data_fname+".new", 'wb')
+
+            data_f.write(bytes(dep11_header, 'utf-8'))
+
+        for pkg in pkglist:
+            pkid = pkg.pkid
+            if new_components:
+                data = self._cache.get_metadata_for_pkg(pkid)
+                if data:
+                    data_f.write(bytes(data, 'utf-8'))
+            hint = self._cache.get_hints(pkid)
+            if hint:
+                hints_f.write(bytes(hint, 'utf-8'))
+
+        if new_components:
+            data_f.close()
+            safe_move_file(data_fname+".new", data_fname)
+
+        hints_f.close()
+        safe_move_file(hints_fname+".new", hints_fname)
+
+
+    def _get_packages_todo(self, suite_name, component, arch):
+        '''
+        Find the packages of an architecture which we did not look at yet.
+        Returns a tuple of all packages, the packages which need to be processed,
+        the new packages we can skip in this run because the Contents data tells us that they
+        don't contain any metadata, and the metadata files of each package (or None, if we have
+        no Contents data).
+        Packages the Contents data doesn't know about are always processed.
+        '''
+        pkglist = list(self._get_packages_for(suite_name, component, arch))
+
+        pkgs_todo = list()
+        for pkg in pkglist:
+            # check if we scanned the package already
+            if self._cache.package_exists(pkg.pkid):
+                continue
+
+            package_fname = os.path.join (self._archive_root, pkg.filename)
+            if not os.path.exists(package_fname):
+                log.warning('Package not found: %s' % (package_fname))
+                continue
+            pkg.filename = package_fname
+            pkgs_todo.append(pkg)
+
+        # use the Contents data to find packages without any metadata files, so they don't
+        # need to be looked at at all. Which files get extracted is decided while reading the package.
+        # The Contents data may lag behind the Packages data, so we don't remember these
+        # packages as ignored, and we never skip packages which aren't in the Contents data.
+        pkgs_skipped = list()
+        metainfo_files = self._get_metainfo_files(suite_name, component, arch) if pkgs_todo else None
+        contents_pkgnames = self._contents_index.get_package_names(suite_name, component, arch) if metainfo_files is not None else None
+        if contents_pkgnames is not None:
+            pkgs_interesting = list()
+            for pkg in pkgs_todo:
+                if metainfo_files.get(pkg.name) or pkg.name not in contents_pkgnames:
+                    pkgs_interesting.append(pkg)
+                else:
+                    pkgs_skipped.append(pkg)
+            if pkgs_skipped:
+                log.info("Skipping %i packages in %s/%s/%s without metadata files." % (len(pkgs_skipped),
+                                                                                     suite_name, component, arch))
+            pkgs_todo = pkgs_interesting
+
+        return pkglist, pkgs_todo, pkgs_skipped, metainfo_files
+
+
+    def _make_extractor(self, suite_name, suite, component, arch, dcache):
+        '''
+        Create a metadata extractor for an architecture, storing its data in the given cache.
+        '''
+        iconh = IconHandler(suite_name, component, arch, self._archive_root,
+                                       suite.get('useIconTheme'), base_suite_name=suite.get('baseSuite'),
+                                       contents_index=self._contents_index,
+                                       media_store=dcache.media_store,
+                                       dcache=dcache,
+                                       index_dir=os.path.join(dcache.cache_dir, "icon-index"))
+        iconh.set_wanted_icon_sizes(self._icon_sizes)
+        return MetadataExtractor(suite_name,
+                                 component,
+                                 dcache,
+                                 iconh,
+                                 package_index=self._package_index,
+                                 arch_name=arch)
+
+
+    def _export_component(self, suite_name, suite, component, jobs, new_components, report):
+        '''
+        Export the metadata and hints of all architectures of a component, and its icon tarball.
+        '''
+        all_cpt_pkgs = list()
+        for arch in suite['architectures']:
+            job = jobs[(component, arch)]
+            all_cpt_pkgs.extend(job['pkglist'])
+            if not job['todo']:
+                continue
+            with report.main.stage('export'):
+                self._write_arch_data(suite_name, suite, component, arch, job['pkglist'], new_components)
+
+        # create icon tarball
+        with report.main.stage('icon-tarball'):
+            self.make_icon_tar(suite_name, component, all_cpt_pkgs)
+
+        log.info("Completed metadata extraction for suite %s/%s" % (suite_name, component))
+
+
     def process_suite(self, suite_name):
         '''
         Extract new metadata for a given suite.
@@ -172,121 +497,252 @@ class DEP11Generator:
         # when using simple fork as startup method.
         mp.set_start_method('forkserver')
 
+        # compile a list of packages that we need to look into, for all components and architectures,
+        # so we can feed them all to one worker pool
+        jobs = dict()
+        # arch:all packages are listed for every architecture, but must only be processed once.
+        # We remember all jobs listing a package, its result counts as done for all of them.
+        pkid_jobs = dict()
+        # The builds of a package version for different architectures usually contain the same
+        # components, which share their global-ids and media. We only process the first build
+        # right away, the others wait until its data is in the cache, so they can reuse it
+        # instead of creating the same media at the same time.
+        # Maps (component, name, version) to the builds waiting for the first one.
+        waiting_builds = dict()
         for component in suite['components']:
-            all_cpt_pkgs = list()
-            new_components = False
             for arch in suite['architectures']:
-                pkglist = self._get_packages_for(suite_name, component, arch)
+                pkglist, pkgs_todo, pkgs_skipped, _ = self._get_packages_todo(suite_name, component, arch)
 
-                # compile a list of packages that we need to look into
-                pkgs_todo = dict()
-                for pkg in pkglist:
-                    pkid = pkg.pkid
+                if not pkgs_todo:
+                    log.info("Skipped %s/%s/%s, no new packages to process." % (suite_name, component, arch))
 
-                    # check if we scanned the package already
-                    if self._cache.package_exists(pkid):
+                pkgs_submit = list()
+                pkgs_waiting = list()
+                for pkg in pkgs_todo:
+                    if pkg.pkid in pkid_jobs:
+                        pkid_jobs[pkg.pkid].append((component, arch))
                         continue
-                    pkgs_todo[pkid] = pkg
+                    pkid_jobs[pkg.pkid] = [(component, arch)]
 
-                if not pkgs_todo:
-                    log.info("Skipped %s/%s/%s, no new packages to process." % (suite_name, component, arch))
+                    build_key = (component, pkg.name, pkg.version)
+                    if build_key in waiting_builds:
+                        waiting_builds[build_key].append(((component, arch), pkg))
+                        pkgs_waiting.append(pkg)
+                    else:
+                        waiting_builds[build_key] = list()
+                        pkgs_submit.append(pkg)
+
+                jobs[(component, arch)] = {'pkglist': pkglist,
+                                           'todo': pkgs_todo,
+                                           'submit': pkgs_submit,
+                                           'waiting': pkgs_waiting,
+                                           'done_count': 0}
+
+        # the icon tarball of a component can be built once all of its architectures are done
+        component_archs_left = dict()
+        for (component, arch), job in jobs.items():
+            if job['todo']:
+                component_archs_left[component] = component_archs_left.get(component, 0) + 1
+
+        if not component_archs_left:
+            return True
+
+        # the results are handled in this (the main) thread, so we can export data
+        # while the workers are still busy with other components
+        results = queue.Queue()
+
+        # whether any new package of a component has components
+        new_components = dict()
+
+        # timing data of all packages and of the work in the main process
+        report = RunReport()
+
+        # set up the metadata extractors. They are sent to every worker process once, when
+        # it is started, so the tasks only need to tell the worker which package to look at.
+        extractors = dict()
+        for (component, arch), job in jobs.items():
+            if not job['submit'] and not job['waiting']:
+                continue
+            extractors[(component, arch)] = self._make_extractor(suite_name, suite, component, arch, self._cache)
+
+        # screenshots are downloaded by a separate process for all workers
+        fetch_manager = FetchManager()
+        fetch_manager.start()
+        fetch_service = fetch_manager.FetchService()
+
+        # restarting a worker means sending all extractors to it again, so we don't do it too often
+        with fetch_manager, \
+                mp.Pool(processes=os.cpu_count(), initializer=init_extract_worker, initargs=(extractors, fetch_service), maxtasksperchild=200) as pool, \
+                self._cache.write_batch(self._cache_batch_size):
+            def handle_error(e):
+                results.put((None, e))
+
+            def submit(key, pkg):
+                pool.apply_async(extract_metadata,
+                            (key, suite_name, pkg.pkid, pkg.filename),
+                            callback=lambda result: results.put((key, result)),
+                            error_callback=handle_error)
+
+            for (component, arch), job in jobs.items():
+                if not job['submit'] and not job['waiting']:
                     continue
 
-                # set up metadata extractor
-                icon_theme = suite.get('useIconTheme')
-                iconh = IconHandler(suite_name, component, arch, self._archive_root,
-                                               icon_theme, base_suite_name=suite.get('baseSuite'))
-                iconh.set_wanted_icon_sizes(self._icon_sizes)
-                mde = MetadataExtractor(suite_name,
-                                component,
-                                self._cache,
-                                iconh)
-
-                # Multiprocessing can't cope with LMDB open in the cache,
-                # but instead of throwing an error or doing something else
-                # that makes debugging easier, it just silently skips each
-                # multprocessing task. Stupid thing.
-                # (remember to re-open the cache later)
-                self._cache.close()
-
-                # set up multiprocessing
-                with mp.Pool(maxtasksperchild=24) as pool:
-                    count = 1
-                    def handle_results(result):
-                        nonlocal count
-                        nonlocal new_components
-                        (message, any_components) = result
-                        new_components = new_components or any_components
-                        log.info(message.format(count, len(pkgs_todo)))
-                        count += 1
-
-                    def handle_error(e):
-                        traceback.print_exception(type(e), e, e.__traceback__)
-                        log.error(str(e))
-                        pool.terminate()
-                        sys.exit(5)
-
-                    log.info("Processing %i packages in %s/%s/%s" % (len(pkgs_todo), suite_name, component, arch))
-                    for pkid, pkg in pkgs_todo.items():
-                        package_fname = os.path.join (self._archive_root, pkg.filename)
-                        if not os.path.exists(package_fname):
-                            log.warning('Package not found: %s' % (package_fname))
-                            continue
-                        pkg.filename = package_fname
-                        pool.apply_async(extract_metadata,
-                                    (mde, suite_name, pkg),
-                                    callback=handle_results, error_callback=handle_error)
-                    pool.close()
-                    pool.join()
-
-                # reopen the cache, we need it
-                self._cache.reopen()
-
-                hints_dir = os.path.join(self._export_dir, "hints", suite_name, component)
-                if not os.path.exists(hints_dir):
-                    os.makedirs(hints_dir)
-                hints_fname = os.path.join(hints_dir, "DEP11Hints_%s.yml.gz" % (arch))
-                hints_f = gzip.open(hints_fname+".new", 'wb')
-
-                dep11_header = get_dep11_header(self._repo_name, suite_name, component, os.path.join(self._dep11_url, component), suite.get('dataPriority', 0))
-
-                dep11_dir = os.path.join(self._export_dir, "data", suite_name, component)
-                if not os.path.exists(dep11_dir):
-                    os.makedirs(dep11_dir)
-
-                if not new_components:
-                    log.info("Skipping %s/%s/%s, no components in any of the new packages.", suite_name, component, arch)
-                else:
-                    # now write data to disk
-                    data_fname = os.path.join(dep11_dir, "Components-%s.yml.gz" % (arch))
+                log.info("Processing %i packages in %s/%s/%s" % (len(job['submit']) + len(job['waiting']),
+                                                                 suite_name, component, arch))
+                for pkg in job['submit']:
+                    submit((component, arch), pkg)
+
+            while component_archs_left:
+                key, result = results.get()
+                if not key:
+                    e = result
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    log.error(str(e))
+                    pool.terminate()
+                    sys.exit(5)
+
+                (message, any_components, cache_writes, pkid, timings) = result
+                report.add_package(pkid, timings)
+                with report.main.stage('cache-write'):
+                    self._cache.apply_batch(cache_writes)
+                log.info(message.format(jobs[key]['done_count'] + 1, len(jobs[key]['todo'])))
+
+                # the builds of this package for other architectures can use its data now
+                name, version = pkid.split('/')[:2]
+                waiting = waiting_builds.pop((key[0], name, version), None)
+                if waiting:
+                    with report.main.stage('cache-write'):
+                        self._cache.commit_batch()
+                    for wkey, wpkg in waiting:
+                        submit(wkey, wpkg)
+
+                for component, arch in pkid_jobs[pkid]:
+                    job = jobs[(component, arch)]
+                    new_components[component] = new_components.get(component, False) or any_components
+                    job['done_count'] += 1
+                    if job['done_count'] < len(job['todo']):
+                        continue
 
-                    data_f = gzip.open(data_fname+".new", 'wb')
+                    component_archs_left[component] -= 1
+                    if component_archs_left[component] > 0:
+                        continue
+                    del component_archs_left[component]
 
-                    data_f.write(bytes(dep11_header, 'utf-8'))
+                    # all architectures of this component have been processed, export the data.
+                    # Make sure everything is in the database before.
+                    with report.main.stage('cache-write'):
+                        self._cache.commit_batch()
+                    self._export_component(suite_name, suite, component, jobs, new_components[component], report)
 
-                for pkg in pkglist:
-                    pkid = pkg.pkid
-                    if new_components:
-                        data = self._cache.get_metadata_for_pkg(pkid)
-                        if data:
-                            data_f.write(bytes(data, 'utf-8'))
-                    hint = self._cache.get_hints(pkid)
-                    if hint:
-                        hints_f.write(bytes(hint, 'utf-8'))
+            pool.close()
+            pool.join()
 
-                if new_components:
-                    data_f.close()
-                    safe_move_file(data_fname+".new", data_fname)
+        # write the timing report next to the hints
+        report_dir = os.path.join(self._export_dir, "hints", suite_name)
+        if not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+        report.write(os.path.join(report_dir, "process-report.json"))
 
-                hints_f.close()
-                safe_move_file(hints_fname+".new", hints_fname)
+        return True
 
-                all_cpt_pkgs.extend(pkglist)
 
-            # create icon tarball
-            self.make_icon_tar(suite_name, component, all_cpt_pkgs)
+    def _package_size(self, pkg):
+        if pkg.size:
+            return pkg.size
+        return os.path.getsize(pkg.filename) if os.path.isfile(pkg.filename) else 0
+
+
+    def _time_sample(self, suite_name, suite, sample):
+        '''
+        Process a sample of packages and return the wall-clock time spent on each of them.
+        The data is written to a scratch cache, so the real cache and media stay untouched.
+        '''
+        durations = list()
+        with tempfile.TemporaryDirectory(prefix="dep11-plan-") as tmp_dir:
+            media_dir = os.path.join(tmp_dir, "media")
+            os.makedirs(media_dir)
+            scratch_cache = DataCache(media_dir)
+            scratch_cache.open(os.path.join(tmp_dir, "cache"))
+            try:
+                extractors = dict()
+                for i, ((component, arch), pkg) in enumerate(sample):
+                    mde = extractors.get((component, arch))
+                    if not mde:
+                        mde = self._make_extractor(suite_name, suite, component, arch, scratch_cache)
+                        extractors[(component, arch)] = mde
+
+                    with timed_package() as timer:
+                        mde.process(pkg)
+                        durations.append(timer.to_dict()['wall'])
+                    log.info("Timed ({0}/{1}): {2} ({3}/{4}) in {5:.2f}s".format(i + 1, len(sample), pkg.name,
+                                                                           suite_name, arch, durations[-1]))
+            finally:
+                scratch_cache.close()
+
+        return durations
+
+
+    def plan_suite(self, suite_name, sample_size=0):
+        '''
+        Estimate the work a run of process_suite() would do, without doing it.
+        If a sample size is given, a random sample of the packages which need to be
+        extracted is processed to extrapolate the time the run would take.
+        '''
 
-            log.info("Completed metadata extraction for suite %s/%s" % (suite_name, component))
+        suite = self._suites_data.get(suite_name)
+        if not suite:
+            log.error("Suite '%s' not found!" % (suite_name))
+            return False
+
+        def format_size(size):
+            return "%.2f GiB" % (size / pow(1024, 3))
+
+        to_extract = list()
+        seen_pkids = set()
+        total_count = 0
+        new_count = 0
+        total_size = 0
+        print("{}:".format(suite_name))
+        for component in suite['components']:
+            for arch in suite['architectures']:
+                pkglist, pkgs_todo, pkgs_skipped, metainfo_files = self._get_packages_todo(suite_name, component, arch)
+                size = sum(self._package_size(pkg) for pkg in pkgs_todo)
+
+                print(" {}/{}".format(component, arch))
+                print("  | -> packages: {}, new: {}".format(len(pkglist), len(pkgs_todo) + len(pkgs_skipped)))
+                if metainfo_files is None and pkgs_todo:
+                    print("  | -> no Contents data, all new packages need to be extracted")
+                print("  | -> to extract: {} ({}), to skip: {}".format(len(pkgs_todo), format_size(size), len(pkgs_skipped)))
+
+                total_count += len(pkglist)
+                new_count += len(pkgs_todo) + len(pkgs_skipped)
+                for pkg in pkgs_todo:
+                    # arch:all packages are listed for every architecture, but only processed once
+                    if pkg.pkid in seen_pkids:
+                        continue
+                    seen_pkids.add(pkg.pkid)
+                    total_size += self._package_size(pkg)
+                    to_extract.append(((component, arch), pkg))
+
+        print("Total:")
+        print("  | -> packages: {}, new: {}".format(total_count, new_count))
+        print("  | -> to extract: {} ({})".format(len(to_extract), format_size(total_size)))
+
+        if not sample_size or not to_extract:
+            return True
+
+        sample = random.sample(to_extract, min(sample_size, len(to_extract)))
+        durations = self._time_sample(suite_name, suite, sample)
+        mean = sum(durations) / len(durations)
+
+        # process_suite() starts one worker per CPU
+        workers = min(os.cpu_count(), len(to_extract))
+        estimate = mean * len(to_extract) / workers
+        print("Estimate:")
+        print("  | -> sampled {} packages, {:.2f}s per package on average".format(len(durations), mean))
+        print("  | -> about {:.0f} minutes with {} workers".format(estimate / 60, workers))
+
+        return True
 
 
     def expire_cache(self):
@@ -295,20 +751,23 @@ class DEP11Generator:
             suite = self._suites_data[suite_name]
             for component in suite['components']:
                 for arch in suite['architectures']:
-                    pkglist = self._get_packages_for(suite_name, component, arch, with_desc=False)
+                    pkglist = self._get_packages_for(suite_name, component, arch)
                     for pkg in pkglist:
                         pkgids.add(pkg.pkid)
 
         # clean cache
         oldpkgs = self._cache.get_packages_not_in_set(pkgids)
-        for pkid in oldpkgs:
-            pkid = str(pkid, 'utf-8')
-            self._cache.remove_package(pkid)
+        with self._cache.write_batch():
+            for pkid in oldpkgs:
+                pkid = str(pkid, 'utf-8')
+                self._cache.remove_package(pkid)
 
         # ensure we don't leave cruft, drop orphaned components (cpts w/o pkg)
         self._cache.remove_orphaned_components()
         # drop orphaned media (media w/o registered cpt)
         self._cache.remove_orphaned_media()
+        # drop report data older versions stored in the cache (only done once)
+        self._cache.upgrade_reports()
 
 
     def remove_processed(self, suite_name):
@@ -321,20 +780,21 @@ class DEP11Generator:
             log.error("Suite '%s' not found!" % (suite_name))
             return False
 
-        for component in suite['components']:
-            for arch in suite['architectures']:
-                pkglist = self._get_packages_for(suite_name, component, arch, with_desc=False)
+        with self._cache.write_batch():
+            for component in suite['components']:
+                for arch in suite['architectures']:
+                    pkglist = self._get_packages_for(suite_name, component, arch)
 
-                for pkg in pkglist:
-                    pkid = pkg.pkid
+                    for pkg in pkglist:
+                        pkid = pkg.pkid
 
-                    # we ignore packages without any interesting metadata here
-                    if self._cache.is_ignored(pkid):
-                        continue
-                    if not self._cache.package_exists(pkid):
-                        continue
+                        # we ignore packages without any interesting metadata here
+                        if self._cache.is_ignored(pkid):
+                            continue
+                        if not self._cache.package_exists(pkid):
+                            continue
 
-                    self._cache.remove_package(pkid)
+                        self._cache.remove_package(pkid)
 
         # drop all components which don't have packages
         self._cache.remove_orphaned_components()
@@ -387,26 +847,25 @@ class DEP11Generator:
 
         for component in suite['components']:
             for arch in suite['architectures']:
-                pkid_filelist = dict()
-                for fname, pkg in parse_contents_file(self._archive_root, suite_name, component, arch):
-                    if not pkid_filelist.get(pkg.pkid):
-                        pkid_filelist[pkg.pkid] = list()
-                    pkid_filelist[pkg.pkid].append(fname)
-
-                for pkid, filelist in pkid_filelist.items():
-                    ignore = True
-                    for f in filelist:
-                        if 'usr/share/applications/' in f:
-                            ignore = False
-                            break
-                        if 'usr/share/metainfo/' in f:
-                            ignore = False
-                            break
-                        if 'usr/share/appdata/' in f:
-                            ignore = False
-                            break
-
-                    if not ignore:
+                if not self._contents_index.update(self._archive_root, suite_name, component, arch):
+                    log.warning("Can not determine packages to ignore for %s/%s/%s without Contents data." % (suite_name, component, arch))
+                    continue
+
+                # find all packages which have any interesting file
+                interesting_pkids = set()
+                for fname, pkg in self._contents_index.get_package_files(self._archive_root, suite_name, component, arch,
+                                                    ['usr/share/applications/', 'usr/share/metainfo/', 'usr/share/appdata/']):
+                    interesting_pkids.add(pkg.pkid)
+
+                # packages which aren't in the Contents data may well have metadata
+                contents_pkgnames = self._contents_index.get_package_names(suite_name, component, arch)
+                if contents_pkgnames is None:
+                    log.warning("Can not determine packages to ignore for %s/%s/%s without Contents data." % (suite_name, component, arch))
+                    continue
+
+                for pkg in self._get_packages_for(suite_name, component, arch):
+                    pkid = pkg.pkid
+                    if pkid in interesting_pkids or pkg.name not in contents_pkgnames:
                         continue
 
                     if self._cache.is_ignored(pkid):
@@ -429,6 +888,7 @@ def main():
 
     parser.usage = "\n"
     parser.usage += " process [CONFDIR] [SUITE]     - Process packages and extract metadata.\n"
+    parser.usage += " plan [CONFDIR] [SUITE] [SAMPLE]  - Estimate the work of processing a suite, timing SAMPLE packages.\n"
     parser.usage += " cleanup [CONFDIR]             - Remove unused data from the cache and expire media.\n"
     parser.usage += " update-reports [CONFDIR] [SUITE]   - Re-generate the metadata and issue HTML pages and update statistics.\n"
     parser.usage += " remove-processed [CONFDIR] [SUITE] - Remove information about processed or failed components.\n"
@@ -457,6 +917,19 @@ def main():
 
         gen.process_suite(params[1])
 
+    elif command == "plan":
+        if len(params) not in (2, 3):
+            print("Invalid number of arguments: You need to specify a DEP-11 data dir and suite.")
+            sys.exit(1)
+        gen = DEP11Generator()
+        ret = gen.initialize(params[0])
+        if not ret:
+            print("Initialization failed, can not continue.")
+            sys.exit(2)
+
+        sample_size = int(params[2]) if len(params) == 3 else 0
+        gen.plan_suite(params[1], sample_size)
+
     elif command == "cleanup":
         if len(params) != 1:
             print("Invalid number of arguments: You need to specify a DEP-11 data dir.")
@@ -17,6 +17,9 @@
 
 import os
 import gzip
+import mmap
+import struct
+import tempfile
 import logging as log
 
 import zlib
@@ -31,6 +34,121 @@ from io import StringIO, BytesIO
 from .component import IconSize, IconType
 from .debfile import DebFile
 from .contentsfile import parse_contents_file
+from .mediastore import data_checksum
+from .profiling import count
+
+
+class IconFileIndex:
+    '''
+    A compact, immutable map of icon filenames to the packages containing them.
+
+    The filenames are stored as a sorted string table in a file, which is memory-mapped
+    when it is used, so all worker processes share the same read-only copy of the data
+    instead of each holding millions of Python strings.
+    If no directory is given to store the file in, the table is kept in memory.
+    '''
+
+    _header = struct.Struct('<8sI')
+    _uint = struct.Struct('<I')
+
+    def __init__(self, files, index_dir=None, name="icons"):
+        '''
+        Build the index from a dict of filenames and Package objects.
+        '''
+        self.packages = list()
+        pkg_ids = dict()
+        names = sorted(files.keys())
+
+        offsets = list()
+        pkg_refs = list()
+        blob = bytearray()
+        for fname in names:
+            pkg = files[fname]
+            pkid = pkg_ids.get(id(pkg))
+            if pkid is None:
+                pkid = len(self.packages)
+                pkg_ids[id(pkg)] = pkid
+                self.packages.append(pkg)
+            offsets.append(len(blob))
+            pkg_refs.append(pkid)
+            blob.extend(bytes(fname, 'utf-8'))
+        offsets.append(len(blob))
+
+        count = len(names)
+        data = bytearray(self._header.pack(b'DEP11ICN', count))
+        data.extend(struct.pack('<%iI' % (count + 1), *offsets))
+        data.extend(struct.pack('<%iI' % (count), *pkg_refs))
+        data.extend(blob)
+
+        self._count = count
+        self._names_start = self._header.size + (2 * count + 1) * self._uint.size
+        self._map = None
+        self._path = None
+        self._data = None
+        if index_dir:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            fd, tmp_path = tempfile.mkstemp(prefix=name, suffix='.tmp', dir=index_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._path = os.path.join(index_dir, "%s.idx" % (name))
+            os.replace(tmp_path, self._path)
+        else:
+            self._data = bytes(data)
+
+
+    def __getstate__(self):
+        # only the location of the data is sent to other processes, they map it themselves
+        state = self.__dict__.copy()
+        state['_map'] = None
+        return state
+
+
+    def __len__(self):
+        return self._count
+
+
+    def _buffer(self):
+        if self._data is not None:
+            return self._data
+        if self._map is None:
+            with open(self._path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+
+    def _name_at(self, buf, i):
+        start, end = struct.unpack_from('<II', buf, self._header.size + i * self._uint.size)
+        return buf[self._names_start + start:self._names_start + end]
+
+
+    def _lower_bound(self, buf, key):
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_at(buf, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def _package_at(self, buf, i):
+        pkg_refs_start = self._header.size + (self._count + 1) * self._uint.size
+        return self.packages[self._uint.unpack_from(buf, pkg_refs_start + i * self._uint.size)[0]]
+
+
+    def get(self, fname):
+        '''
+        Return the package containing the given file, or None.
+        '''
+        buf = self._buffer()
+        key = bytes(fname, 'utf-8')
+        i = self._lower_bound(buf, key)
+        if i < self._count and self._name_at(buf, i) == key:
+            return self._package_at(buf, i)
+        return None
 
 
 class Theme:
@@ -89,11 +207,19 @@ class IconHandler:
     to find icons not already present in the package file itself.
     '''
 
-    def __init__(self, suite_name, archive_component, arch_name, archive_mirror_dir, icon_theme=None, base_suite_name=None):
+    def __init__(self, suite_name, archive_component, arch_name, archive_mirror_dir, icon_theme=None, base_suite_name=None, contents_index=None, media_store=None, dcache=None, index_dir=None):
         self._component = archive_component
         self._mirror_dir = archive_mirror_dir
+        # rendered icons are shared via the media store, so we only render identical icons once
+        self._media_store = media_store
+        # the data cache keeps a manifest of the icons we stored
+        self._dcache = dcache
+        # the Contents index is only used while loading data, we drop the reference
+        # to it afterwards so this object can still be sent to other processes
+        self._contents_index = contents_index
 
         self._themes = list()
+        # all icon files we know about, this is turned into an IconFileIndex once all data is loaded
         self._icon_files = dict()
 
         self._wanted_icon_sizes = [IconSize(64), IconSize(128)],
@@ -125,6 +251,11 @@ class IconHandler:
         if os.path.isfile(universe_cfname):
             self._load_contents_data(arch_name, suite_name, "universe")
 
+        self._contents_index = None
+
+        self._icon_files = IconFileIndex(self._icon_files, index_dir,
+                                         "icons-%s-%s-%s" % (suite_name, archive_component, arch_name))
+
         loaded_themes = set(theme.name for theme in self._themes)
         missing = set(self._theme_names) - loaded_themes
         for theme in missing:
@@ -137,11 +268,19 @@ class IconHandler:
             self._wanted_icon_sizes.append(IconSize(strsize))
 
 
+    def _read_contents_data(self, arch_name, suite_name, component):
+        if not self._contents_index:
+            return parse_contents_file(self._mirror_dir, suite_name, component, arch_name)
+
+        prefixes = ['usr/share/pixmaps/']
+        prefixes.extend(['usr/share/icons/{}'.format(name) for name in self._theme_names])
+        return self._contents_index.get_package_files(self._mirror_dir, suite_name, component, arch_name, prefixes)
+
+
     def _load_contents_data(self, arch_name, suite_name, component):
         # load and preprocess the large file.
-        # we don't show mercy to memory here, we just want the icon lookup to be fast,
-        # so we need to cache the data.
-        for fname, pkg in parse_contents_file(self._mirror_dir, suite_name, component, arch_name):
+        # we want the icon lookup to be fast, so we need to cache the data.
+        for fname, pkg in self._read_contents_data(arch_name, suite_name, component):
             if fname.startswith('usr/share/pixmaps/'):
                 self._icon_files[fname] = pkg
                 continue
@@ -217,7 +356,8 @@ class IconHandler:
                 if not icon_dict:
                     return False, None
 
-                icon_stored = False
+                # select the icon files we want to store for each size
+                selected_icons = list()
                 last_icon_name = None
                 for size in self._wanted_icon_sizes:
                     info = icon_dict.get(size)
@@ -235,11 +375,7 @@ class IconHandler:
 
                     last_icon_name = info['icon_fname']
                     if self._icon_allowed(last_icon_name):
-                        icon_stored = self._store_icon(info['pkg'],
-                                                cpt,
-                                                cpt_export_path,
-                                                last_icon_name,
-                                                size) or icon_stored
+                        selected_icons.append((size, info))
                     else:
                         # the found icon is not suitable, but maybe a larger one is available that we can downscale?
                         for asize, data in icon_dict.items():
@@ -248,13 +384,22 @@ class IconHandler:
                             info = data
                             break
                         if self._icon_allowed(info['icon_fname']):
-                            icon_stored = self._store_icon(info['pkg'],
-                                                cpt,
-                                                cpt_export_path,
-                                                info['icon_fname'],
-                                                size) or icon_stored
+                            selected_icons.append((size, info))
                             last_icon_name = info['icon_fname']
 
+                # extract the icon data from each package in one go
+                icons_data = self._extract_icons_data(selected_icons)
+
+                icon_stored = False
+                for size, info in selected_icons:
+                    icon_data = icons_data.get((info['pkg'].filename, info['icon_fname']))
+                    icon_stored = self._store_icon(info['pkg'],
+                                            cpt,
+                                            cpt_export_path,
+                                            info['icon_fname'],
+                                            size,
+                                            icon_data) or icon_stored
+
                 return icon_stored, last_icon_name
 
 
@@ -279,6 +424,36 @@ class IconHandler:
         return True
 
 
+    def _extract_icons_data(self, icons):
+        '''
+        Extract the data of the given icons, reading each package only once.
+        Returns a dictionary mapping (package filename, icon filename) to the icon data.
+        '''
+
+        pkg_icons = dict()
+        for size, info in icons:
+            pkg = info['pkg']
+            if not pkg.filename or not os.path.exists(pkg.filename):
+                continue
+            if pkg.filename not in pkg_icons:
+                pkg_icons[pkg.filename] = (pkg, set())
+            pkg_icons[pkg.filename][1].add(info['icon_fname'])
+
+        icons_data = dict()
+        for pkg_fname, (pkg, icon_fnames) in pkg_icons.items():
+            try:
+                files_data = pkg.debfile.get_files_data(icon_fnames)
+            except Exception as e:
+                # we will try again for the individual icons, and emit a proper error then
+                log.debug("Unable to extract icons from '%s': %s" % (pkg_fname, str(e)))
+                continue
+            count('bytes-read', sum(len(data) for data in files_data.values() if data))
+            for fname, data in files_data.items():
+                icons_data[(pkg_fname, fname)] = data
+
+        return icons_data
+
+
     def _icon_allowed(self, icon):
         '''
         Check if the icon is an icon we actually can and want to handle.
@@ -308,11 +483,17 @@ class IconHandler:
         img.write_to_png(store_path)
 
 
-    def _store_icon(self, pkg, cpt, cpt_export_path, icon_path, size):
+    def _register_icon(self, cpt, fname, store_key=None):
+        if self._dcache:
+            self._dcache.add_media(cpt.global_id, self._component, 'icon', fname, store_key=store_key)
+
+
+    def _store_icon(self, pkg, cpt, cpt_export_path, icon_path, size, icon_data=None):
         '''
         Extracts the icon from the deb package and stores it in the cache.
         Ensures the stored icon always has the size given in "size", and renders
         vectorgraphics if necessary.
+        If the icon data has already been extracted, it can be passed as "icon_data".
         '''
 
         # don't store an icon if we are already ignoring this component
@@ -338,15 +519,17 @@ class IconHandler:
         if os.path.exists(icon_store_location):
             # we already extracted that icon, skip the extraction step
             # change scalable vector graphics to their .png extension
+            self._register_icon(cpt, icon_store_location)
             cpt.set_icon(IconType.CACHED, icon_name)
             return True
 
         # filepath is checked because icon can reside in another binary
         # eg amarok's icon is in amarok-data
-        icon_data = None
         try:
-            deb = pkg.debfile
-            icon_data = deb.get_file_data(icon_path)
+            if icon_data is None:
+                deb = pkg.debfile
+                icon_data = deb.get_file_data(icon_path)
+                count('bytes-read', len(icon_data) if icon_data else 0)
         except Exception as e:
             cpt.add_hint("deb-extract-error", {'fname': icon_name, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)})
             return False
@@ -359,6 +542,19 @@ class IconHandler:
 
         # FIXME: Maybe close the debfile again to not leak FDs? Could hurt performance though.
 
+        # the same icon is often shipped by many packages (e.g. in icon themes), so
+        # check if we rendered it already
+        store_key = None
+        if self._media_store:
+            store_key = "icons/%s_%s%s" % (data_checksum(icon_data), str(size), os.path.splitext(icon_name)[1])
+            if self._media_store.get(store_key):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                self._media_store.link_to(store_key, icon_store_location)
+                self._register_icon(cpt, icon_store_location, store_key)
+                cpt.set_icon(IconType.CACHED, icon_name)
+                return True
+
         if icon_name_orig.endswith(".svg"):
             svgicon = True
         elif icon_name_orig.endswith(".svgz"):
@@ -378,7 +574,6 @@ class IconHandler:
         if svgicon:
             # render the SVG to a bitmap
             self._render_svg_to_png(icon_data, icon_store_location, int(size), int(size))
-            return True
         else:
             # we don't trust upstream to have the right icon size present, and therefore
             # always adjust the icon to the right size
@@ -392,6 +587,8 @@ class IconHandler:
                 return False
             newimg = img.resize((int(size), int(size)), Image.ANTIALIAS)
             newimg.save(icon_store_location)
-            return True
 
-        return False
+        if store_key:
+            self._media_store.add(store_key, icon_store_location)
+        self._register_icon(cpt, icon_store_location, store_key)
+        return True
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import shutil
+import hashlib
+import logging as log
+
+
+__all__ = list()
+
+
+def data_checksum(data):
+    '''
+    Return the checksum used to address data in a MediaStore.
+    '''
+    return hashlib.sha256(data).hexdigest()
+
+__all__.append('data_checksum')
+
+
+def screenshot_key(checksum, variant='source'):
+    '''
+    Return the key of a screenshot (or one of its thumbnails) in a MediaStore.
+    '''
+    return "screenshots/%s_%s.png" % (checksum, variant)
+
+__all__.append('screenshot_key')
+
+
+class MediaStore:
+    '''
+    A content-addressed store for generated media files.
+
+    Files are stored under a key, which should be derived from the checksum of the data
+    they were generated from. Stored files are hardlinked to the locations where they
+    are needed, so the link count of a file in the store tells us whether it is still in use.
+    '''
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+
+
+    def _path(self, key):
+        dirname, basename = os.path.split(key)
+        return os.path.join(self._store_dir, dirname, basename[:2], basename)
+
+
+    def get(self, key):
+        '''
+        Return the path of the file stored under the given key, or None if
+        it does not exist.
+        '''
+        path = self._path(key)
+        if os.path.isfile(path):
+            return path
+        return None
+
+
+    def add(self, key, fname):
+        '''
+        Add the file fname to the store, using the given key.
+        '''
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # other processes might add the same file at the same time, so we
+        # move the data into place atomically
+        tmp_path = "%s.%i.tmp" % (path, os.getpid())
+        try:
+            os.link(fname, tmp_path)
+        except OSError:
+            shutil.copyfile(fname, tmp_path)
+        os.replace(tmp_path, path)
+
+
+    def link_to(self, key, dest):
+        '''
+        Link the file stored under key to dest (or copy it, if we can not create a hardlink).
+        Returns False if nothing is stored under the given key.
+        '''
+        path = self.get(key)
+        if not path:
+            return False
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+        return True
+
+
+    def remove(self, key):
+        '''
+        Remove the file stored under the given key, unless it is still linked to a
+        location outside of the store.
+        Returns True if the file was removed.
+        '''
+        path = self._path(key)
+        try:
+            if os.stat(path).st_nlink > 1:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning("Unable to prune stored media file '%s': %s" % (path, str(e)))
+            return False
+        return True
+
+
+    def prune(self):
+        '''
+        Remove all files which are not linked to any location outside of the store anymore.
+        This needs to look at every stored file, so it should only be used if we don't know
+        which files are unused.
+        If the store is located on a different filesystem than the exported data, we can
+        not track usage of the stored files and they will all be removed.
+        '''
+        if not os.path.isdir(self._store_dir):
+            return 0
+
+        count = 0
+        for dirpath, dirs, files in os.walk(self._store_dir):
+            for fname in files:
+                path = os.path.join(dirpath, fname)
+                try:
+                    if os.stat(path).st_nlink > 1:
+                        continue
+                    os.remove(path)
+                    count += 1
+                except OSError as e:
+                    log.warning("Unable to prune stored media file '%s': %s" % (path, str(e)))
+
+        log.debug("Pruned %i files from media store" % (count))
+        return count
+
+__all__.append('MediaStore')
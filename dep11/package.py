@@ -18,12 +18,31 @@
 import os
 import gzip
 import bz2
+import lmdb
 import logging as log
 from .debfile import DebFile
 from apt_pkg import TagFile, version_compare
 from xml.sax.saxutils import escape
 
 
+def description_to_html(desc):
+    '''
+    Convert a Debian package description to the HTML markup used in AppStream.
+    '''
+    if desc.startswith('<p>'):
+        return desc
+    desc_lines = desc.split('\n')
+    desc_as = '<p>'
+    for line in desc_lines:
+        line = line.strip()
+        if line == '.':
+            desc_as += '</p><p>'
+            continue
+        desc_as += escape(line)
+    desc_as += '</p>'
+    return desc_as
+
+
 class Package:
 
     def __init__(self, name, version, arch, fname=None):
@@ -32,6 +51,7 @@ class Package:
         self.arch = arch
         self.filename = fname
         self.maintainer = None
+        self.size = 0
 
         self._description = dict()
         self._debfile = None
@@ -75,44 +95,46 @@ class Package:
     def set_description(self, locale, desc):
         if not desc:
             return
-        if desc.startswith('<p>'):
-            self._description[locale] = desc
-        else:
-            desc_lines = desc.split('\n')
-            desc_as = '<p>'
-            for line in desc_lines:
-                line = line.strip()
-                if line == '.':
-                    desc_as += '</p><p>'
-                    continue
-                desc_as += escape(line)
-            desc_as += '</p>'
-            self._description[locale] = desc_as
+        self._description[locale] = description_to_html(desc)
 
 
     def has_description(self):
         return True if self.description else False
 
 
-def read_packages_dict_from_file(archive_root, suite, component, arch, with_description=False):
-    source_path = archive_root + "/dists/%s/%s/binary-%s/Packages.gz" % (suite, component, arch)
+def get_packages_fname(archive_root, suite, component, arch):
+    return archive_root + "/dists/%s/%s/binary-%s/Packages.gz" % (suite, component, arch)
+
+
+def get_l10n_en_fname(archive_root, suite, component):
+    return archive_root + "/dists/%s/%s/i18n/Translation-en.bz2" % (suite, component)
 
+
+def _read_l10n_descriptions(archive_root, suite, component):
     pkgl10n = dict()
-    if with_description:
-        l10n_en_source_path = archive_root + "/dists/%s/%s/i18n/Translation-en.bz2" % (suite, component)
-        if os.path.exists(l10n_en_source_path):
-            try:
-                l10n_file = bz2.open(l10n_en_source_path, mode='rb')
-                l10ntagf = TagFile(l10n_file)
-                for section in l10ntagf:
-                    pkgname = section.get('Package')
-                    if not pkgname:
-                        continue
-                    pkgl10n[pkgname] = dict()
-                    pkgl10n[pkgname]['C'] = section.get('Description-en')
-                l10n_file.close()
-            except Exception as e:
-                log.warning("Could not use i18n file '{}': {}".format(l10n_en_source_path, str(e)))
+    l10n_en_source_path = get_l10n_en_fname(archive_root, suite, component)
+    if os.path.exists(l10n_en_source_path):
+        try:
+            l10n_file = bz2.open(l10n_en_source_path, mode='rb')
+            l10ntagf = TagFile(l10n_file)
+            for section in l10ntagf:
+                pkgname = section.get('Package')
+                if not pkgname:
+                    continue
+                pkgl10n[pkgname] = dict()
+                pkgl10n[pkgname]['C'] = section.get('Description-en')
+            l10n_file.close()
+        except Exception as e:
+            log.warning("Could not use i18n file '{}': {}".format(l10n_en_source_path, str(e)))
+    return pkgl10n
+
+
+def _read_packages_file(archive_root, suite, component, arch):
+    '''
+    Parse a Packages file and return a dict of the newest version of every package,
+    mapping the package name to a tuple of the Package and its description.
+    '''
+    source_path = get_packages_fname(archive_root, suite, component, arch)
 
     f = gzip.open(source_path, 'rb')
     tagf = TagFile(f)
@@ -120,23 +142,293 @@ def read_packages_dict_from_file(archive_root, suite, component, arch, with_desc
     for section in tagf:
         pkg = Package(section['Package'], section['Version'], section['Architecture'])
         if not section.get('Filename'):
-            print("Package %s-%s has no filename specified." % (pkg['name'], pkg['version']))
+            print("Package %s-%s has no filename specified." % (pkg.name, pkg.version))
             continue
         pkg.filename = section['Filename']
         pkg.maintainer = section['Maintainer']
-
-        if with_description:
-            if pkgl10n.get(pkg.name):
-                pkg.set_description('C', pkgl10n[pkg.name].get('C'))
-            else:
-                pkg.set_description('C', section.get('Description'))
+        pkg.size = int(section.get('Size', 0))
 
         pkg2 = package_dict.get(pkg.name)
         if pkg2:
-            compare = version_compare(pkg2.version, pkg.version)
+            compare = version_compare(pkg2[0].version, pkg.version)
             if compare >= 0:
                 continue
-        package_dict[pkg.name] = pkg
+        package_dict[pkg.name] = (pkg, section.get('Description'))
     f.close()
 
     return package_dict
+
+
+def read_packages_dict_from_file(archive_root, suite, component, arch, with_description=False):
+    pkgl10n = dict()
+    if with_description:
+        pkgl10n = _read_l10n_descriptions(archive_root, suite, component)
+
+    package_dict = dict()
+    for name, (pkg, desc) in _read_packages_file(archive_root, suite, component, arch).items():
+        if with_description:
+            if pkgl10n.get(pkg.name):
+                pkg.set_description('C', pkgl10n[pkg.name].get('C'))
+            else:
+                pkg.set_description('C', desc)
+        package_dict[name] = pkg
+
+    return package_dict
+
+
+class PackageIndex:
+    """
+    A persistent, LMDB based index of the Packages and Translation-en files of an archive.
+
+    Packages data is keyed by suite/component/arch, descriptions from the Translation-en
+    file are keyed by suite/component and shared by all architectures. Every part of the
+    index is only rebuilt if the checksum of its source file listed in the suite's Release
+    file changes, so every command working on the same archive can share the parsed data.
+    Package descriptions are only read (and converted to HTML) if they are actually needed.
+    """
+
+    def __init__(self):
+        self._pkgsdb = None
+        self._descdb = None
+        self._l10ndb = None
+        self._sourcesdb = None
+        self._dbenv = None
+        self._opened = False
+        self._index_dir = None
+
+        # sources we already checked for changes in this process
+        self._checked = set()
+
+        # use the same maximum size as the other LMDB databases
+        self._map_size = pow(1024, 4)
+
+
+    def open(self, index_dir):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self._dbenv = lmdb.open(index_dir, max_dbs=4, map_size=self._map_size, metasync=False)
+
+        self._pkgsdb = self._dbenv.open_db(b'packages')
+        self._descdb = self._dbenv.open_db(b'descriptions')
+        self._l10ndb = self._dbenv.open_db(b'translations')
+        self._sourcesdb = self._dbenv.open_db(b'sources')
+
+        self._opened = True
+        self._index_dir = index_dir
+        return True
+
+
+    def close(self):
+        if not self._opened:
+            return
+        self._dbenv.close()
+
+        self._pkgsdb = None
+        self._descdb = None
+        self._l10ndb = None
+        self._sourcesdb = None
+        self._dbenv = None
+        self._opened = False
+
+
+    def reopen(self):
+        if self._opened:
+            return
+        self.open(self._index_dir)
+
+
+    def __getstate__(self):
+        # LMDB handles can not be shared with other processes, the receiving
+        # process reopens the index when it is used.
+        state = self.__dict__.copy()
+        for key in state.keys():
+            if key.endswith('db'):
+                state[key] = None
+        state['_dbenv'] = None
+        state['_opened'] = False
+        return state
+
+
+    def _index_prefix(self, *parts):
+        return bytes("/".join(parts), 'utf-8')
+
+
+    def _source_stamp(self, archive_root, suite, source_fname, release_path):
+        '''
+        Return the checksum of a source file from the Release file, or its
+        modification time and size if we can not find it there.
+        '''
+        release_fname = os.path.join(archive_root, "dists", suite, "Release")
+        if os.path.isfile(release_fname):
+            try:
+                with open(release_fname, 'rb') as f:
+                    for section in TagFile(f):
+                        for line in section.get('SHA256', '').split('\n'):
+                            parts = line.split()
+                            if len(parts) == 3 and parts[2] == release_path:
+                                return bytes("%s %s" % (source_fname, parts[0]), 'utf-8')
+                        break
+            except Exception as e:
+                log.warning("Could not read Release file '{}': {}".format(release_fname, str(e)))
+
+        if not os.path.isfile(source_fname):
+            return bytes("%s missing" % (source_fname), 'utf-8')
+        st = os.stat(source_fname)
+        return bytes("%s %i %i" % (source_fname, st.st_mtime_ns, st.st_size), 'utf-8')
+
+
+    def _drop_index(self, db, prefix):
+        with self._dbenv.begin(db=db, write=True) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                while cursor.key().startswith(prefix):
+                    if not cursor.delete():
+                        break
+
+
+    def _is_current(self, source_key, stamp):
+        with self._dbenv.begin(db=self._sourcesdb) as txn:
+            if txn.get(source_key) == stamp:
+                self._checked.add(source_key)
+                return True
+        with self._dbenv.begin(db=self._sourcesdb, write=True) as txn:
+            txn.delete(source_key)
+        return False
+
+
+    def _mark_current(self, source_key, stamp):
+        # only mark an index as valid once it is complete
+        with self._dbenv.begin(db=self._sourcesdb, write=True) as txn:
+            txn.put(source_key, stamp)
+        self._checked.add(source_key)
+
+
+    def _update_translations(self, archive_root, suite, component):
+        source_key = self._index_prefix(suite, component, "i18n")
+        if source_key in self._checked:
+            return
+        stamp = self._source_stamp(archive_root, suite,
+                                   get_l10n_en_fname(archive_root, suite, component),
+                                   "%s/i18n/Translation-en.bz2" % (component))
+        if self._is_current(source_key, stamp):
+            return
+
+        log.info("Building Translation-en index for %s/%s" % (suite, component))
+        prefix = self._index_prefix(suite, component) + b'\0'
+        self._drop_index(self._l10ndb, prefix)
+
+        pkgl10n = _read_l10n_descriptions(archive_root, suite, component)
+        with self._dbenv.begin(db=self._l10ndb, write=True) as txn:
+            for name, desc in pkgl10n.items():
+                if desc.get('C'):
+                    txn.put(prefix + bytes(name, 'utf-8'), bytes(desc['C'], 'utf-8'))
+
+        self._mark_current(source_key, stamp)
+
+
+    def update(self, archive_root, suite, component, arch):
+        '''
+        Ensure the index for the given suite/component/arch is in sync
+        with the Packages and Translation-en files in the archive, and rebuild it if necessary.
+        '''
+
+        self._update_translations(archive_root, suite, component)
+
+        source_key = self._index_prefix(suite, component, arch)
+        if source_key in self._checked:
+            return
+        stamp = self._source_stamp(archive_root, suite,
+                                   get_packages_fname(archive_root, suite, component, arch),
+                                   "%s/binary-%s/Packages.gz" % (component, arch))
+        if self._is_current(source_key, stamp):
+            return
+
+        log.info("Building Packages index for %s/%s/%s" % (suite, component, arch))
+        prefix = source_key + b'\0'
+        self._drop_index(self._pkgsdb, prefix)
+        self._drop_index(self._descdb, prefix)
+
+        package_dict = _read_packages_file(archive_root, suite, component, arch)
+        with self._dbenv.begin(write=True) as txn:
+            for name, (pkg, desc) in package_dict.items():
+                key = prefix + bytes(name, 'utf-8')
+                data = "\0".join([pkg.version, pkg.arch, pkg.filename, pkg.maintainer, str(pkg.size)])
+                txn.put(key, bytes(data, 'utf-8'), db=self._pkgsdb)
+                if desc:
+                    txn.put(key, bytes(desc, 'utf-8'), db=self._descdb)
+
+        self._mark_current(source_key, stamp)
+
+
+    def get_description(self, suite, component, arch, pkg):
+        '''
+        Return the description of a package as dict of locale and HTML markup,
+        or None if it has none.
+        The arch is the one of the Packages file the package was read from, which is not
+        the package's own architecture for arch:all packages.
+        The index needs to have been updated for the suite/component/arch before.
+        '''
+
+        self.reopen()
+
+        name = bytes(pkg.name, 'utf-8')
+        with self._dbenv.begin() as txn:
+            desc = txn.get(self._index_prefix(suite, component) + b'\0' + name, db=self._l10ndb)
+            if not desc:
+                desc = txn.get(self._index_prefix(suite, component, arch) + b'\0' + name, db=self._descdb)
+            if not desc:
+                return None
+            return {'C': description_to_html(str(desc, 'utf-8'))}
+
+
+    def iter_packages(self, archive_root, suite, component, arch, chunk_size=1000):
+        '''
+        Yield the packages of the given suite/component/arch, sorted by name.
+        The packages are read in chunks, so we never keep a read transaction open
+        while the caller works on them.
+        '''
+
+        self.update(archive_root, suite, component, arch)
+
+        prefix = self._index_prefix(suite, component, arch) + b'\0'
+        start_key = prefix
+        while True:
+            chunk = list()
+            with self._dbenv.begin(db=self._pkgsdb) as txn:
+                cursor = txn.cursor()
+                if cursor.set_range(start_key):
+                    for key, value in cursor:
+                        if not key.startswith(prefix) or len(chunk) >= chunk_size:
+                            break
+                        chunk.append((key, value))
+
+            for key, value in chunk:
+                name = str(key[len(prefix):], 'utf-8')
+                version, arch_name, fname, maintainer, size = str(value, 'utf-8').split('\0')
+                pkg = Package(name, version, arch_name, fname)
+                pkg.maintainer = maintainer
+                pkg.size = int(size)
+                yield pkg
+
+            if len(chunk) < chunk_size:
+                return
+            # continue right after the last key we have seen
+            start_key = chunk[-1][0] + b'\0'
+
+
+    def get_packages(self, archive_root, suite, component, arch, with_description=False):
+        '''
+        Works like read_packages_dict_from_file(), but reads the data from the index.
+        '''
+
+        package_dict = dict()
+        for pkg in self.iter_packages(archive_root, suite, component, arch):
+            package_dict[pkg.name] = pkg
+
+        if with_description:
+            for pkg in package_dict.values():
+                desc = self.get_description(suite, component, arch, pkg)
+                if desc:
+                    pkg.set_description('C', desc['C'])
+
+        return package_dict
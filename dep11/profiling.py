@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import time
+import json
+import math
+from contextlib import contextmanager
+
+
+__all__ = list()
+
+# the timer of the package which is currently processed in this process
+_current_timer = None
+
+
+class StageTimer:
+    '''
+    Records the wall-clock and CPU time spent in named stages of some work,
+    as well as counters (e.g. the amount of bytes read).
+    Stages may be nested, the time of a stage always includes the time of its sub-stages.
+    '''
+
+    def __init__(self):
+        self._stages = dict()
+        self._counters = dict()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+
+    @contextmanager
+    def stage(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            data = self._stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            data['wall'] += time.perf_counter() - start_wall
+            data['cpu'] += time.process_time() - start_cpu
+            data['calls'] += 1
+
+
+    def count(self, name, value):
+        self._counters[name] = self._counters.get(name, 0) + value
+
+
+    def to_dict(self):
+        return {'wall': time.perf_counter() - self._start_wall,
+                'cpu': time.process_time() - self._start_cpu,
+                'stages': self._stages,
+                'counters': self._counters}
+
+__all__.append('StageTimer')
+
+
+@contextmanager
+def stage(name):
+    '''
+    Record the time spent in the given stage for the package which is currently
+    being processed. Does nothing if no package timer is active.
+    '''
+    if _current_timer is None:
+        yield
+        return
+    with _current_timer.stage(name):
+        yield
+
+__all__.append('stage')
+
+
+def count(name, value):
+    '''
+    Add to a counter of the package which is currently being processed.
+    '''
+    if _current_timer is not None:
+        _current_timer.count(name, value)
+
+__all__.append('count')
+
+
+@contextmanager
+def timed_package():
+    '''
+    Make a new StageTimer the timer of the package which is currently processed,
+    for the duration of this context.
+    '''
+    global _current_timer
+    timer = StageTimer()
+    _current_timer = timer
+    try:
+        yield timer
+    finally:
+        _current_timer = None
+
+__all__.append('timed_package')
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return dict()
+    def nearest_rank(p):
+        return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+    return {'min': values[0],
+            'p50': nearest_rank(50),
+            'p90': nearest_rank(90),
+            'p99': nearest_rank(99),
+            'max': values[-1]}
+
+
+class RunReport:
+    '''
+    Collects the timing data of all packages of a run, and of the work the main
+    process does, and writes a summary of it as JSON.
+    '''
+
+    def __init__(self, top_count=20):
+        self.main = StageTimer()
+        self._packages = list()
+        self._top_count = top_count
+
+
+    def add_package(self, pkid, timings):
+        self._packages.append((pkid, timings))
+
+
+    def to_dict(self):
+        stage_names = set()
+        counter_names = set()
+        for pkid, timings in self._packages:
+            stage_names.update(timings['stages'].keys())
+            counter_names.update(timings['counters'].keys())
+
+        stages = dict()
+        for name in sorted(stage_names):
+            wall = [t['stages'][name]['wall'] for p, t in self._packages if name in t['stages']]
+            cpu = [t['stages'][name]['cpu'] for p, t in self._packages if name in t['stages']]
+            stages[name] = {'wall': sum(wall),
+                            'cpu': sum(cpu),
+                            'packages': len(wall),
+                            'wall_percentiles': _percentiles(wall)}
+
+        counters = dict()
+        for name in sorted(counter_names):
+            counters[name] = sum(t['counters'].get(name, 0) for p, t in self._packages)
+
+        slowest = sorted(self._packages, key=lambda x: x[1]['wall'], reverse=True)[:self._top_count]
+
+        return {'packages': len(self._packages),
+                'main': self.main.to_dict(),
+                'totals': {'wall': sum(t['wall'] for p, t in self._packages),
+                           'cpu': sum(t['cpu'] for p, t in self._packages),
+                           'counters': counters},
+                'wall_percentiles': _percentiles([t['wall'] for p, t in self._packages]),
+                'stages': stages,
+                'slowest': [dict(pkid=pkid, **timings) for pkid, timings in slowest]}
+
+
+    def write(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+__all__.append('RunReport')
@@ -16,16 +16,22 @@
 # License along with this program.
 
 import os
+import json
 import yaml
 import shutil
 import time
-from jinja2 import Environment, FileSystemLoader
+import heapq
+import itertools
+import collections
+import hashlib
+import multiprocessing as mp
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import logging as log
 
 from dep11 import DataCache, __version__
 from .component import dict_to_dep11_yaml
 from .utils import get_data_dir, load_generator_config
-from .package import read_packages_dict_from_file
+from .package import PackageIndex
 from .hints import get_hint_tag_info
 from .validate import DEP11Validator
 from .statsgenerator import StatsGenerator
@@ -38,6 +44,38 @@ except:
     pygments = None
 
 
+# the template environment of this process and the variables every page gets, see init_render_worker()
+_render_env = None
+_render_globals = None
+
+def init_render_worker(template_dir, bytecode_cache_dir, render_globals):
+    '''
+    Set up the template environment of a process rendering report pages.
+    Compiled templates are kept in a bytecode cache on disk, so they are only
+    compiled again if they change.
+    '''
+    global _render_env, _render_globals
+    os.makedirs(bytecode_cache_dir, exist_ok=True)
+    _render_env = Environment(loader=FileSystemLoader(template_dir),
+                              bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir))
+    _render_globals = render_globals
+
+
+def render_page(name, out_path, variables):
+    # create subdirectories if necessary
+    out_dir = os.path.dirname(os.path.realpath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+
+    template = _render_env.get_template(name)
+    args = dict(_render_globals)
+    args.update(variables)
+    content = template.render(**args)
+    # never write into an existing file, it might be linked to a page of the previous run
+    with open(out_path+".new", 'wb') as f:
+        f.write(bytes(content, 'utf-8'))
+    os.replace(out_path+".new", out_path)
+
+
 def equal_dicts(d1, d2, ignore_keys):
     ignored = set(ignore_keys)
     for k1, v1 in d1.items():
@@ -91,35 +129,106 @@ class ReportGenerator:
         self._cache = DataCache(os.path.join(self._export_dir, "media"))
         self._cache.open(cache_dir)
 
+        self._package_index = PackageIndex()
+        self._package_index.open(os.path.join(cache_dir, "packages"))
+
+        # the expanded hints of this run, by tag and parameters
+        self._expanded_hints = dict()
+
+        # the highlighted metadata we store in the cache depends on these
+        self._fragment_version = "%s/%s" % (__version__, pygments.__version__ if pygments else "none")
+
+        # maximum amount of pages waiting to be rendered by the worker processes
+        self._render_queue_size = conf.get("ReportRenderQueueSize", 1000)
+
+        # all pages of a run share the same template environment, which we compile once
+        self._render_args = (self._template_dir,
+                             os.path.join(cache_dir, "templates"),
+                             {'root_url': self._html_url,
+                              'distro': self._distro_name,
+                              'time': time.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                              'generator_version': __version__})
+        init_render_worker(*self._render_args)
+
+        # pages are only rendered again if their data or the templates change
+        template_hash = hashlib.sha256(bytes("\0".join([__version__, self._html_url, self._distro_name]), 'utf-8'))
+        for name in sorted(_render_env.list_templates(filter_func=lambda x: x.endswith(".html"))):
+            _render_env.get_template(name)
+            template_hash.update(bytes(name, 'utf-8'))
+            with open(os.path.join(self._template_dir, name), 'rb') as f:
+                template_hash.update(f.read())
+        self._template_version = template_hash.hexdigest()
+
         os.chdir(dep11_dir)
         return True
 
 
-    def _get_packages_for(self, suite, component, arch):
-        return read_packages_dict_from_file(self._archive_root, suite, component, arch).values()
+    def _get_page_path(self, name, out_dir, out_name):
+        if not out_name:
+            return os.path.join(out_dir, name)
+        return os.path.join(out_dir, out_name)
 
 
-    def render_template(self, name, out_dir, out_name = None, *args, **kwargs):
-        if not out_name:
-            out_path = os.path.join(out_dir, name)
-        else:
-            out_path = os.path.join(out_dir, out_name)
-        # create subdirectories if necessary
-        out_dir = os.path.dirname(os.path.realpath(out_path))
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-
-        j2_env = Environment(loader=FileSystemLoader(self._template_dir))
-
-        template = j2_env.get_template(name)
-        content = template.render(root_url = self._html_url,
-                                    distro = self._distro_name,
-                                    time = time.strftime("%Y-%m-%d %H:%M:%S %Z"),
-                                    generator_version = __version__,
-                                    *args, **kwargs)
+    def render_template(self, name, out_dir, out_name = None, **kwargs):
+        out_path = self._get_page_path(name, out_dir, out_name)
         log.debug("Render: %s" % (out_path.replace(self._html_export_dir, "")))
-        with open(out_path, 'wb') as f:
-            f.write(bytes(content, 'utf-8'))
+        render_page(name, out_path, kwargs)
+
+
+    def _render_template_async(self, pool, pending, name, out_dir, out_name = None, **kwargs):
+        '''
+        Render a page in the worker pool. At most ReportRenderQueueSize pages are queued,
+        so we don't keep the data of many more pages in memory than we can render.
+        '''
+        out_path = self._get_page_path(name, out_dir, out_name)
+        log.debug("Render: %s" % (out_path.replace(self._html_export_dir, "")))
+        pending.append(pool.apply_async(render_page, (name, out_path, kwargs)))
+        while len(pending) > self._render_queue_size:
+            # raises the exception of the worker, if rendering failed
+            pending.popleft().get()
+
+
+    def _wait_rendered(self, pending):
+        while pending:
+            pending.popleft().get()
+
+
+    def _update_page(self, pool, pending, section_dir, build_dir, old_fingerprints, fingerprints, name, page_path, **kwargs):
+        '''
+        Render a page of a report section into the build directory, unless the data and templates
+        it is rendered from did not change since the last run. In that case the old page is linked
+        into the build directory instead, keeping its modification time.
+        Returns True if the page needs to be rendered.
+        '''
+        fingerprint = hashlib.sha256(bytes(json.dumps([self._template_version, name, kwargs], sort_keys=True),
+                                           'utf-8')).hexdigest()
+        fingerprints[page_path] = fingerprint
+
+        old_path = os.path.join(section_dir, page_path)
+        if old_fingerprints.get(page_path) == fingerprint and os.path.isfile(old_path):
+            new_path = os.path.join(build_dir, page_path)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            try:
+                os.link(old_path, new_path)
+            except OSError:
+                shutil.copy2(old_path, new_path)
+            return False
+
+        self._render_template_async(pool, pending, name, build_dir, page_path, **kwargs)
+        return True
+
+
+    def _replace_dir(self, old_dir, new_dir):
+        '''
+        Replace a directory with a new one, so it is only missing for the time
+        between two renames.
+        '''
+        trash_dir = old_dir + ".old"
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        if os.path.isdir(old_dir):
+            os.rename(old_dir, trash_dir)
+        os.rename(new_dir, old_dir)
+        shutil.rmtree(trash_dir, ignore_errors=True)
 
 
     def _highlight_yaml(self, yml_data):
@@ -148,6 +257,231 @@ class ReportGenerator:
         return {'tag_name': tag_name, 'description': desc, 'severity': severity}
 
 
+    def _get_hint_fragment(self, hint_data):
+        '''
+        Return the expanded hint. Expanded hints are kept in memory, so every hint
+        only needs to be expanded once per run.
+        '''
+        hint_key = (hint_data.get('tag'), json.dumps(hint_data.get('params'), sort_keys=True, default=str))
+        ehint = self._expanded_hints.get(hint_key)
+        if ehint is None:
+            ehint = self._expand_hint(hint_data)
+            self._expanded_hints[hint_key] = ehint
+        return ehint
+
+
+    def _get_component_fragment(self, gid):
+        '''
+        Return the data of a component the report pages need, including its highlighted YAML,
+        or None if the component does not exist.
+        The metadata of a global-id never changes, so we store this in the cache and only
+        need to generate it once for all runs and suites.
+        '''
+        fragment = self._cache.get_report_fragment('mdata', gid)
+        if fragment:
+            fragment = json.loads(str(fragment, 'utf-8'))
+            if fragment.get('version') == self._fragment_version:
+                return fragment
+
+        mdata = self._cache.get_metadata(gid)
+        if not mdata:
+            return None
+        mdata = yaml.safe_load(mdata)
+
+        fragment = {'version': self._fragment_version,
+                    'package': mdata.get('Package')}
+        if fragment['package']:
+            # ugly hack to have the screenshot entries linked
+            #if mdata.get('Screenshots'):
+            #    sshot_baseurl = os.path.join(self._dep11_url, component)
+            #    for i in range(len(mdata['Screenshots'])):
+            #        url = mdata['Screenshots'][i]['source-image']['url']
+            #        url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
+            #        mdata['Screenshots'][i]['source-image']['url'] = Markup(url)
+            #        thumbnails = mdata['Screenshots'][i]['thumbnails']
+            #        for j in range(len(thumbnails)):
+            #            url = thumbnails[j]['url']
+            #            url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
+            #            thumbnails[j]['url'] = Markup(url)
+            #        mdata['Screenshots'][i]['thumbnails'] = thumbnails
+
+            fragment['mdata'] = self._highlight_yaml(dict_to_dep11_yaml(mdata))
+            fragment['id'] = mdata.get('ID')
+            fragment['type'] = mdata['Type']
+            fragment['icon'] = None
+            if mdata['Type'] == 'desktop-app' or mdata['Type'] == "web-app":
+                fragment['icon'] = mdata['Icon'].get("cached")
+
+        self._cache.set_report_fragment('mdata', gid, bytes(json.dumps(fragment), 'utf-8'))
+        return fragment
+
+
+    def _iter_package_groups(self, suite_name, component, archs):
+        '''
+        Yield the name of every package of a component together with a list of
+        (arch, package) tuples for all architectures it is built for.
+        The package index returns the packages of each architecture sorted by name,
+        so we merge these lists instead of loading all of them first.
+        '''
+
+        def arch_packages(arch_idx, arch):
+            for pkg in self._package_index.iter_packages(self._archive_root, suite_name, component, arch):
+                yield pkg.name, arch_idx, arch, pkg
+
+        merged = heapq.merge(*[arch_packages(i, arch) for i, arch in enumerate(archs)])
+        for name, group in itertools.groupby(merged, key=lambda x: x[0]):
+            yield name, [(arch, pkg) for _, _, arch, pkg in group]
+
+
+    def _collect_package_pages(self, component, pkgs, issue_summaries, mdata_summaries, counts):
+        '''
+        Collect the issue and metainfo page data of a package on all of its architectures,
+        and add it to the summaries and issue counts of the component.
+        '''
+
+        media_dir = os.path.join(self._export_dir, "media")
+        noimage_url = os.path.join(self._html_url, "static", "img", "no-image.png")
+
+        hint_pages = dict()
+        cpt_pages = dict()
+        for arch, pkg in pkgs:
+            pkid = pkg.pkid
+
+            maintainer = None
+            if pkg:
+                maintainer = pkg.maintainer
+            if not maintainer:
+                maintainer = "Unknown"
+
+            #
+            # Data processing hints
+            #
+            hints_list = self._cache.get_hints(pkid)
+            if hints_list:
+                hints_list = yaml.safe_load_all(hints_list)
+                for hdata in hints_list:
+                    pkg_name = hdata['Package']
+                    pkg_id = hdata.get('PackageID')
+                    if not pkg_id:
+                        pkg_id = pkg_name
+                    if not issue_summaries.get(maintainer):
+                        issue_summaries[maintainer] = dict()
+
+                    hints_raw = hdata.get('Hints', list())
+
+                    # expand all hints to show long descriptions
+                    errors = list()
+                    warnings = list()
+                    infos = list()
+
+                    for hint in hints_raw:
+                        ehint = self._get_hint_fragment(hint)
+                        severity = ehint['severity']
+                        if severity == "info":
+                            infos.append(ehint)
+                        elif severity == "warning":
+                            warnings.append(ehint)
+                        else:
+                            errors.append(ehint)
+
+                    if not hint_pages.get(pkg_name):
+                        hint_pages[pkg_name] = list()
+
+                    # we fold multiple architectures with the same issues into one view
+                    pkid_noarch = pkg_id
+                    if "/" in pkg_id:
+                        pkid_noarch = pkg_id[:pkg_id.rfind("/")]
+
+                    pcid = ""
+                    if hdata.get('ID'):
+                        pcid = "%s: %s" % (pkid_noarch, hdata.get('ID'))
+                    else:
+                        pcid = pkid_noarch
+
+                    page_data = {'identifier': pcid, 'errors': errors, 'warnings': warnings, 'infos': infos, 'archs': [arch]}
+                    try:
+                        l = hint_pages[pkg_name]
+                        index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
+                        hint_pages[pkg_name][index]['archs'].append(arch)
+                    except StopIteration:
+                        hint_pages[pkg_name].append(page_data)
+
+                        # add info to global issue count
+                        counts['errors'] += len(errors)
+                        counts['warnings'] += len(warnings)
+                        counts['infos'] += len(infos)
+
+                        # add info for global index
+                        if not issue_summaries[maintainer].get(pkg_name):
+                            issue_summaries[maintainer][pkg_name] = {'error_count': len(errors), 'warning_count': len(warnings), 'info_count': len(infos)}
+
+
+            #
+            # Component metadata
+            #
+            cptgids = self._cache.get_cpt_gids_for_pkg(pkid)
+            if cptgids:
+                for cptgid in cptgids:
+                    cpt_data = self._get_component_fragment(cptgid)
+                    if not cpt_data:
+                        log.error("Package '%s' refers to missing component with gid '%s'" % (pkid, cptgid))
+                        continue
+
+                    pkg_name = cpt_data['package']
+                    if not pkg_name:
+                        # we probably hit the header
+                        continue
+                    if not mdata_summaries.get(maintainer):
+                        mdata_summaries[maintainer] = dict()
+
+                    mdata_yml = cpt_data['mdata']
+                    cid = cpt_data['id']
+
+                    # try to find an icon for this component (if it's a GUI app)
+                    icon_url = None
+                    if cpt_data['type'] == 'desktop-app' or cpt_data['type'] == "web-app":
+                        icon_name = cpt_data['icon']
+                        if icon_name:
+                            icon_fname = os.path.join(component, cptgid, "icons", "64x64", icon_name)
+                            if os.path.isfile(os.path.join(media_dir, icon_fname)):
+                                icon_url = os.path.join(self._dep11_url, icon_fname)
+                            else:
+                                icon_url = noimage_url
+                        else:
+                            icon_url = noimage_url
+                    else:
+                        icon_url = os.path.join(self._html_url, "static", "img", "cpt-nogui.png")
+
+                    if not cpt_pages.get(pkg_name):
+                        cpt_pages[pkg_name] = list()
+
+                    page_data = {'cid': cid, 'mdata': mdata_yml, 'icon_url': icon_url, 'archs': [arch]}
+                    try:
+                        l = cpt_pages[pkg_name]
+                        index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
+                        cpt_pages[pkg_name][index]['archs'].append(arch)
+                    except StopIteration:
+                        cpt_pages[pkg_name].append(page_data)
+
+                        # increase valid metainfo count
+                        counts['metainfo'] += 1
+
+                    # check if we had this package, and add to summary
+                    pksum = mdata_summaries[maintainer].get(pkg_name)
+                    if not pksum:
+                        pksum = dict()
+
+                    if pksum.get('cids'):
+                        if not cid in pksum['cids']:
+                            pksum['cids'].append(cid)
+                    else:
+                        pksum['cids'] = [cid]
+
+                    mdata_summaries[maintainer][pkg_name] = pksum
+
+        return hint_pages, cpt_pages
+
+
     def update_reports(self, suite_name):
         dep11_hintsdir = os.path.join(self._export_dir, "hints")
         if not os.path.exists(dep11_hintsdir):
@@ -162,8 +496,6 @@ class ReportGenerator:
             return False
 
         export_dir_root = self._html_export_dir
-        media_dir = os.path.join(self._export_dir, "media")
-        noimage_url = os.path.join(self._html_url, "static", "img", "no-image.png")
 
         # Render archive suites index page
         self.render_template("suites_index.html", export_dir_root, "index.html", suites=self._suites_data.keys())
@@ -177,244 +509,115 @@ class ReportGenerator:
         suite_info_count = 0
         suite_metainfo_count = 0
 
-        for component in suite['components']:
-            issue_summaries = dict()
-            mdata_summaries = dict()
-            export_dir_section = os.path.join(self._export_dir, "html", suite_name, component)
-            export_dir_issues = os.path.join(export_dir_section, "issues")
-            export_dir_metainfo = os.path.join(export_dir_section, "metainfo")
-
-            error_count = 0
-            warning_count = 0
-            info_count = 0
-            metainfo_count = 0
-
-            hint_pages = dict()
-            cpt_pages = dict()
-
-            for arch in suite['architectures']:
-                pkglist = self._get_packages_for(suite_name, component, arch)
-
-                for pkg in pkglist:
-                    pkid = pkg.pkid
-
-                    maintainer = None
-                    if pkg:
-                        maintainer = pkg.maintainer
-                    if not maintainer:
-                        maintainer = "Unknown"
-
-                    #
-                    # Data processing hints
-                    #
-                    hints_list = self._cache.get_hints(pkid)
-                    if hints_list:
-                        hints_list = yaml.safe_load_all(hints_list)
-                        for hdata in hints_list:
-                            pkg_name = hdata['Package']
-                            pkg_id = hdata.get('PackageID')
-                            if not pkg_id:
-                                pkg_id = pkg_name
-                            if not issue_summaries.get(maintainer):
-                                issue_summaries[maintainer] = dict()
-
-                            hints_raw = hdata.get('Hints', list())
-
-                            # expand all hints to show long descriptions
-                            errors = list()
-                            warnings = list()
-                            infos = list()
-
-                            for hint in hints_raw:
-                                ehint = self._expand_hint(hint)
-                                severity = ehint['severity']
-                                if severity == "info":
-                                    infos.append(ehint)
-                                elif severity == "warning":
-                                    warnings.append(ehint)
-                                else:
-                                    errors.append(ehint)
-
-                            if not hint_pages.get(pkg_name):
-                                hint_pages[pkg_name] = list()
-
-                            # we fold multiple architectures with the same issues into one view
-                            pkid_noarch = pkg_id
-                            if "/" in pkg_id:
-                                pkid_noarch = pkg_id[:pkg_id.rfind("/")]
-
-                            pcid = ""
-                            if hdata.get('ID'):
-                                pcid = "%s: %s" % (pkid_noarch, hdata.get('ID'))
-                            else:
-                                pcid = pkid_noarch
-
-                            page_data = {'identifier': pcid, 'errors': errors, 'warnings': warnings, 'infos': infos, 'archs': [arch]}
-                            try:
-                                l = hint_pages[pkg_name]
-                                index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
-                                hint_pages[pkg_name][index]['archs'].append(arch)
-                            except StopIteration:
-                                hint_pages[pkg_name].append(page_data)
-
-                                # add info to global issue count
-                                error_count += len(errors)
-                                warning_count += len(warnings)
-                                info_count += len(infos)
-
-                                # add info for global index
-                                if not issue_summaries[maintainer].get(pkg_name):
-                                    issue_summaries[maintainer][pkg_name] = {'error_count': len(errors), 'warning_count': len(warnings), 'info_count': len(infos)}
-
-
-                    #
-                    # Component metadata
-                    #
-                    cptgids = self._cache.get_cpt_gids_for_pkg(pkid)
-                    if cptgids:
-                        for cptgid in cptgids:
-                            mdata = self._cache.get_metadata(cptgid)
-                            if not mdata:
-                                log.error("Package '%s' refers to missing component with gid '%s'" % (pkid, cptgid))
-                                continue
-                            mdata = yaml.safe_load(mdata)
-
-                            pkg_name = mdata.get('Package')
-                            if not pkg_name:
-                                # we probably hit the header
-                                continue
-                            if not mdata_summaries.get(maintainer):
-                                mdata_summaries[maintainer] = dict()
-
-
-                            # ugly hack to have the screenshot entries linked
-                            #if mdata.get('Screenshots'):
-                            #    sshot_baseurl = os.path.join(self._dep11_url, component)
-                            #    for i in range(len(mdata['Screenshots'])):
-                            #        url = mdata['Screenshots'][i]['source-image']['url']
-                            #        url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
-                            #        mdata['Screenshots'][i]['source-image']['url'] = Markup(url)
-                            #        thumbnails = mdata['Screenshots'][i]['thumbnails']
-                            #        for j in range(len(thumbnails)):
-                            #            url = thumbnails[j]['url']
-                            #            url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
-                            #            thumbnails[j]['url'] = Markup(url)
-                            #        mdata['Screenshots'][i]['thumbnails'] = thumbnails
-
-
-                            mdata_yml = dict_to_dep11_yaml(mdata)
-                            mdata_yml = self._highlight_yaml(mdata_yml)
-                            cid = mdata.get('ID')
-
-                            # try to find an icon for this component (if it's a GUI app)
-                            icon_url = None
-                            if mdata['Type'] == 'desktop-app' or mdata['Type'] == "web-app":
-                                icon_name = mdata['Icon'].get("cached")
-                                if icon_name:
-                                    icon_fname = os.path.join(component, cptgid, "icons", "64x64", icon_name)
-                                    if os.path.isfile(os.path.join(media_dir, icon_fname)):
-                                        icon_url = os.path.join(self._dep11_url, icon_fname)
-                                    else:
-                                        icon_url = noimage_url
-                                else:
-                                    icon_url = noimage_url
-                            else:
-                                icon_url = os.path.join(self._html_url, "static", "img", "cpt-nogui.png")
-
-                            if not cpt_pages.get(pkg_name):
-                                cpt_pages[pkg_name] = list()
-
-                            page_data = {'cid': cid, 'mdata': mdata_yml, 'icon_url': icon_url, 'archs': [arch]}
-                            try:
-                                l = cpt_pages[pkg_name]
-                                index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
-                                cpt_pages[pkg_name][index]['archs'].append(arch)
-                            except StopIteration:
-                                cpt_pages[pkg_name].append(page_data)
-
-                                # increase valid metainfo count
-                                metainfo_count += 1
-
-                            # check if we had this package, and add to summary
-                            pksum = mdata_summaries[maintainer].get(pkg_name)
-                            if not pksum:
-                                pksum = dict()
-
-                            if pksum.get('cids'):
-                                if not cid in pksum['cids']:
-                                    pksum['cids'].append(cid)
-                            else:
-                                pksum['cids'] = [cid]
-
-                            mdata_summaries[maintainer][pkg_name] = pksum
-
-
-            #
-            # Summary and HTML writing
-            #
-
-            log.info("Rendering HTML pages for suite '%s/%s'" % (suite_name, component))
-
-            # remove old HTML pages
-            shutil.rmtree(export_dir_section, ignore_errors=True)
-
-            # now write the HTML pages with the previously collected & transformed issue data
-            for pkg_name, entry_list in hint_pages.items():
-                # render issues page
-                self.render_template("issues_page.html", export_dir_issues, "%s.html" % (pkg_name),
-                        package_name=pkg_name, entries=entry_list, suite=suite_name, section=component)
-
-            # render page with all components found in a package
-            for pkg_name, cptlist in cpt_pages.items():
-                # render metainfo page
-                self.render_template("metainfo_page.html", export_dir_metainfo, "%s.html" % (pkg_name),
-                        package_name=pkg_name, cpts=cptlist, suite=suite_name, section=component)
-
-            # Now render our issue index page
-            self.render_template("issues_index.html", export_dir_issues, "index.html",
-                        package_summaries=issue_summaries, suite=suite_name, section=component)
-
-            # ... and the metainfo index page
-            self.render_template("metainfo_index.html", export_dir_metainfo, "index.html",
-                        package_summaries=mdata_summaries, suite=suite_name, section=component)
-
-
-            validate_result = "Validation was not performed."
-            d_fname = os.path.join(dep11_minfodir, suite_name, component, "Components-%s.yml.gz" % (arch))
-            if os.path.isfile(d_fname):
-                # do format validation
-                validator = DEP11Validator()
-                ret = validator.validate_file(d_fname)
-                if ret:
-                    validate_result = "No errors found."
-                else:
-                    validate_result = ""
-                    for issue in validator.issue_list:
-                        validate_result += issue.replace("FATAL", "<strong>FATAL</strong>")+"<br/>\n"
-
-            # sum up counts for suite statistics
-            suite_metainfo_count += metainfo_count
-            suite_error_count += error_count
-            suite_warning_count += warning_count
-            suite_info_count += info_count
-
-            # add current statistics to the statistics database
-            stats.add_data(suite_name, component, metainfo_count, error_count, warning_count, info_count)
-
-            # calculate statistics for this component
-            count = metainfo_count + error_count + warning_count + info_count
-            valid_perc = 100/count*metainfo_count if count > 0 else 0
-            error_perc = 100/count*error_count if count > 0 else 0
-            warning_perc = 100/count*warning_count if count > 0 else 0
-            info_perc = 100/count*info_count if count > 0 else 0
-
-            # Render our overview page
-            self.render_template("section_overview.html", export_dir_section, "index.html",
-                        suite=suite_name, section=component, valid_percentage=valid_perc,
-                        error_percentage=error_perc, warning_percentage=warning_perc, info_percentage=info_perc,
-                        metainfo_count=metainfo_count, error_count=error_count, warning_count=warning_count,
-                        info_count=info_count, validate_result=validate_result)
-
+        # the pages of the individual packages are rendered and written by a pool of workers.
+        # We don't fork, so the workers don't inherit our LMDB handles.
+        # The report fragments we generate are written to the cache in batches.
+        # If anything goes wrong, the workers are terminated when we leave this block.
+        pending = collections.deque()
+        with mp.get_context('forkserver').Pool(initializer=init_render_worker, initargs=self._render_args) as pool, \
+                self._cache.write_batch():
+            for component in suite['components']:
+                issue_summaries = dict()
+                mdata_summaries = dict()
+                export_dir_section = os.path.join(self._export_dir, "html", suite_name, component)
+
+                # the pages are written to a new directory, which replaces the old one once it is complete
+                build_dir = export_dir_section + ".new"
+                shutil.rmtree(build_dir, ignore_errors=True)
+                export_dir_issues = os.path.join(build_dir, "issues")
+                export_dir_metainfo = os.path.join(build_dir, "metainfo")
+
+                section_id = "%s/%s" % (suite_name, component)
+                old_fingerprints = self._cache.get_report_fingerprints(section_id)
+                fingerprints = dict()
+                rendered_count = 0
+
+                counts = {'errors': 0, 'warnings': 0, 'infos': 0, 'metainfo': 0}
+
+                log.info("Rendering HTML pages for suite '%s/%s'" % (suite_name, component))
+
+                # write the pages of every package as soon as we have its data for all architectures,
+                # so we only keep the summaries for the index pages in memory
+                for i, (pkg_name, pkgs) in enumerate(self._iter_package_groups(suite_name, component, suite['architectures'])):
+                    hint_pages, cpt_pages = self._collect_package_pages(component, pkgs, issue_summaries, mdata_summaries, counts)
+                    if (i + 1) % 500 == 0:
+                        self._cache.commit_batch()
+
+                    for hpkg_name, entry_list in hint_pages.items():
+                        # render issues page
+                        rendered_count += self._update_page(pool, pending, export_dir_section, build_dir, old_fingerprints, fingerprints,
+                                "issues_page.html", os.path.join("issues", "%s.html" % (hpkg_name)),
+                                package_name=hpkg_name, entries=entry_list, suite=suite_name, section=component)
+
+                    # render page with all components found in a package
+                    for cpkg_name, cptlist in cpt_pages.items():
+                        # render metainfo page
+                        rendered_count += self._update_page(pool, pending, export_dir_section, build_dir, old_fingerprints, fingerprints,
+                                "metainfo_page.html", os.path.join("metainfo", "%s.html" % (cpkg_name)),
+                                package_name=cpkg_name, cpts=cptlist, suite=suite_name, section=component)
+
+                # all package pages need to be written before we can publish the new directory
+                self._wait_rendered(pending)
+                removed_count = len(set(old_fingerprints.keys()) - set(fingerprints.keys()))
+                log.info("Rendered %i of %i package pages for suite '%s/%s', removed %i." % (rendered_count, len(fingerprints),
+                                                                                         suite_name, component, removed_count))
+
+                error_count = counts['errors']
+                warning_count = counts['warnings']
+                info_count = counts['infos']
+                metainfo_count = counts['metainfo']
+
+                # Now render our issue index page
+                self.render_template("issues_index.html", export_dir_issues, "index.html",
+                            package_summaries=issue_summaries, suite=suite_name, section=component)
+
+                # ... and the metainfo index page
+                self.render_template("metainfo_index.html", export_dir_metainfo, "index.html",
+                            package_summaries=mdata_summaries, suite=suite_name, section=component)
+
+
+                validate_result = "Validation was not performed."
+                d_fname = os.path.join(dep11_minfodir, suite_name, component, "Components-%s.yml.gz" % (suite['architectures'][-1]))
+                if os.path.isfile(d_fname):
+                    # do format validation
+                    validator = DEP11Validator()
+                    ret = validator.validate_file(d_fname)
+                    if ret:
+                        validate_result = "No errors found."
+                    else:
+                        validate_result = ""
+                        for issue in validator.issue_list:
+                            validate_result += issue.replace("FATAL", "<strong>FATAL</strong>")+"<br/>\n"
+
+                # sum up counts for suite statistics
+                suite_metainfo_count += metainfo_count
+                suite_error_count += error_count
+                suite_warning_count += warning_count
+                suite_info_count += info_count
+
+                # add current statistics to the statistics database
+                stats.add_data(suite_name, component, metainfo_count, error_count, warning_count, info_count)
+
+                # calculate statistics for this component
+                count = metainfo_count + error_count + warning_count + info_count
+                valid_perc = 100/count*metainfo_count if count > 0 else 0
+                error_perc = 100/count*error_count if count > 0 else 0
+                warning_perc = 100/count*warning_count if count > 0 else 0
+                info_perc = 100/count*info_count if count > 0 else 0
+
+                # Render our overview page
+                self.render_template("section_overview.html", build_dir, "index.html",
+                            suite=suite_name, section=component, valid_percentage=valid_perc,
+                            error_percentage=error_perc, warning_percentage=warning_perc, info_percentage=info_perc,
+                            metainfo_count=metainfo_count, error_count=error_count, warning_count=warning_count,
+                            info_count=info_count, validate_result=validate_result)
+
+                # publish the new pages, and remember what we rendered them from
+                self._replace_dir(export_dir_section, build_dir)
+                self._cache.set_report_fingerprints(section_id, fingerprints)
+
+            pool.close()
+            pool.join()
 
         # calculate statistics for this suite
         count = suite_metainfo_count + suite_error_count + suite_warning_count + suite_info_count
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import sys
+import time
+import threading
+import unittest
+import http.server
+import multiprocessing as mp
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dep11.fetcher import MediaFetcher, FetchManager, RemoteMediaFetcher
+
+
+ETAG = '"abc123"'
+LAST_MODIFIED = 'Sat, 01 Oct 2016 12:00:00 GMT'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+
+        if self.headers.get('If-None-Match') == ETAG or self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+
+        data = bytes(self.path, 'utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _fetch_in_process(service, urls, results):
+    fetcher = RemoteMediaFetcher(service)
+    requests = [fetcher.fetch(url) for url in urls]
+    results.put([request.result().data for request in requests])
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        # make sure we talk to our server directly
+        env = {k: v for k, v in os.environ.items() if not k.lower().endswith('_proxy')}
+        self._env_patch = mock.patch.dict(os.environ, env, clear=True)
+        self._env_patch.start()
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.connections = 0
+        self._server.active = 0
+        self._server.max_active = 0
+        self._server.delay = 0
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._base_url = 'http://127.0.0.1:%i' % (self._server.server_address[1])
+
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._env_patch.stop()
+
+
+    def test_keep_alive(self):
+        fetcher = MediaFetcher(max_threads=4, max_per_host=1)
+        for i in range(5):
+            result = fetcher.fetch('%s/shot-%i.png' % (self._base_url, i)).result()
+            self.assertIsNone(result.error)
+            self.assertEqual(result.data, bytes('/shot-%i.png' % (i), 'utf-8'))
+        fetcher.close()
+        self.assertEqual(self._server.connections, 1)
+
+
+    def test_per_host_limit(self):
+        self._server.delay = 0.2
+        fetcher = MediaFetcher(max_threads=8, max_per_host=2)
+        requests = [fetcher.fetch('%s/shot-%i.png' % (self._base_url, i)) for i in range(6)]
+        for request in requests:
+            self.assertIsNone(request.result().error)
+        fetcher.close()
+        self.assertEqual(self._server.max_active, 2)
+
+
+    def test_not_modified(self):
+        fetcher = MediaFetcher()
+        url = self._base_url + '/shot.png'
+        result = fetcher.fetch(url).result()
+        self.assertFalse(result.not_modified)
+        self.assertEqual(result.etag, ETAG)
+        self.assertEqual(result.last_modified, LAST_MODIFIED)
+
+        result = fetcher.fetch(url, etag=ETAG).result()
+        self.assertTrue(result.not_modified)
+        self.assertIsNone(result.data)
+
+        result = fetcher.fetch(url, last_modified=LAST_MODIFIED).result()
+        self.assertTrue(result.not_modified)
+        self.assertIsNone(result.data)
+        fetcher.close()
+
+
+    def test_shared_service(self):
+        self._server.delay = 0.2
+        ctx = mp.get_context('fork')
+        with FetchManager(ctx=ctx) as manager:
+            service = manager.FetchService(8, 2)
+            results = ctx.Queue()
+            procs = list()
+            for n in range(3):
+                urls = ['%s/shot-%i-%i.png' % (self._base_url, n, i) for i in range(3)]
+                proc = ctx.Process(target=_fetch_in_process, args=(service, urls, results))
+                proc.start()
+                procs.append(proc)
+
+            data = list()
+            for proc in procs:
+                data.extend(results.get(timeout=30))
+            for proc in procs:
+                proc.join()
+
+        self.assertEqual(sorted(data), sorted(bytes('/shot-%i-%i.png' % (n, i), 'utf-8')
+                                              for n in range(3) for i in range(3)))
+        # the limit of connections to the host applies to all processes together
+        self.assertEqual(self._server.max_active, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
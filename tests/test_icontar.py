@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dep11.generator import DEP11Generator
+
+
+class FakePackage:
+    def __init__(self, pkid):
+        self.pkid = pkid
+
+
+class FakeCache:
+    '''
+    Just enough of a DataCache for building icon tarballs.
+    '''
+
+    def __init__(self, gids):
+        self._gids = gids
+        self._members = dict()
+
+    def get_cpt_gids_for_pkg(self, pkid):
+        return self._gids.get(pkid)
+
+    def get_icon_tar_member(self, gid, size):
+        return self._members.get((gid, size))
+
+    def set_icon_tar_member(self, gid, size, names, member):
+        self._members[(gid, size)] = (names, member)
+
+
+class IconTarballTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="dep11-test-")
+        self._icon_data = b'\x89PNG\r\n\x1a\nnot really an image'
+
+        # two components share the same icon, which is hardlinked from the media store
+        store_fname = os.path.join(self._tmp_dir, "media-store", "ab", "abcdef.png")
+        os.makedirs(os.path.dirname(store_fname))
+        with open(store_fname, 'wb') as f:
+            f.write(self._icon_data)
+
+        media_dir = os.path.join(self._tmp_dir, "export", "media")
+        for gid, name in [("p/pkg1/gid1", "pkg1_a.png"), ("p/pkg2/gid2", "pkg2_b.png")]:
+            icon_dir = os.path.join(media_dir, "main", gid, "icons", "64x64")
+            os.makedirs(icon_dir)
+            os.link(store_fname, os.path.join(icon_dir, name))
+
+        self._gen = DEP11Generator()
+        self._gen._export_dir = os.path.join(self._tmp_dir, "export")
+        self._gen._icon_sizes = ["64x64"]
+        self._gen._cache = FakeCache({'pkg1/1.0/amd64': ["p/pkg1/gid1"],
+                                      'pkg2/1.0/amd64': ["p/pkg2/gid2"]})
+        os.makedirs(os.path.join(self._gen._export_dir, "data", "sid", "main"))
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+
+    def _check_tarball(self):
+        self._gen.make_icon_tar("sid", "main", [FakePackage('pkg1/1.0/amd64'), FakePackage('pkg2/1.0/amd64')])
+
+        tar_fname = os.path.join(self._gen._export_dir, "data", "sid", "main", "icons-64x64.tar.gz")
+        with tarfile.open(tar_fname, 'r:gz') as tar:
+            members = tar.getmembers()
+            self.assertEqual(sorted(m.name for m in members), ["pkg1_a.png", "pkg2_b.png"])
+            for member in members:
+                self.assertTrue(member.isreg())
+                self.assertEqual(member.size, len(self._icon_data))
+                self.assertEqual(tar.extractfile(member).read(), self._icon_data)
+
+
+    def test_shared_icon(self):
+        self._gen._incremental_export = False
+        self._check_tarball()
+
+
+    def test_shared_icon_incremental(self):
+        self._gen._incremental_export = True
+        self._check_tarball()
+
+
+    def test_multiarch_component_incremental(self):
+        # the builds of a package for different architectures share their components
+        self._gen._incremental_export = True
+        self._gen._cache = FakeCache({'pkg1/1.0/amd64': ["p/pkg1/gid1"],
+                                      'pkg1/1.0/i386': ["p/pkg1/gid1"]})
+
+        built = list()
+        build_member = self._gen._build_icon_tar_member
+        def count_builds(component, gid, size, names_seen=None):
+            built.append(gid)
+            return build_member(component, gid, size, names_seen)
+        self._gen._build_icon_tar_member = count_builds
+
+        for run in range(2):
+            self._gen.make_icon_tar("sid", "main", [FakePackage('pkg1/1.0/amd64'), FakePackage('pkg1/1.0/i386')])
+        self.assertEqual(built, ["p/pkg1/gid1"])
+
+        tar_fname = os.path.join(self._gen._export_dir, "data", "sid", "main", "icons-64x64.tar.gz")
+        with tarfile.open(tar_fname, 'r:gz') as tar:
+            self.assertEqual(tar.getnames(), ["pkg1_a.png"])
+
+
+if __name__ == '__main__':
+    unittest.main()